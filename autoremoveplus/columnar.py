@@ -0,0 +1,230 @@
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+
+"""columnar.py: numpy evaluation of the remove policy for autoremove plus."""
+
+__author__      = "Jools"
+__email__       = "springjools@gmail.com"
+__copyright__   = "Copyright 2019"
+
+# Deluge is free software.
+#
+# You may redistribute it and/or modify it under the terms of the
+# GNU General Public License, as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# deluge is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with deluge.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+#
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .policy import Decision, NO_DECISION
+from .policy import ACT_REMOVE, ACT_PAUSE, ACT_SEED_REMOVE, ACT_SEED_PAUSE
+
+import logging
+log = logging.getLogger(__name__)
+
+# Status key each remove rule reads, and the divisor turning it into the
+# value filter_funcs gives. Unknown rules fall back to the ratio.
+METRIC_COLUMNS = {
+    'func_ratio': ('ratio', None),
+    'func_added': ('time_added', None),
+    'func_seed_time': ('seeding_time', 86400.0),
+    'func_seeders': ('total_seeds', None),
+    'func_availability': ('distributed_copies', None)
+}
+
+
+def available():
+    return numpy is not None
+
+
+class Columns(object):
+    """The snapshots of one cycle as numpy arrays, one per status key.
+
+    Metrics come out bit for bit equal to filter_funcs, so selections and
+    decisions are the same as those of the per torrent code in policy.py.
+    """
+
+    def __init__(self, snapshots, now):
+        self.snapshots = snapshots
+        self.count = len(snapshots)
+        self.now = now
+        self._status = {}
+        self._metrics = {}
+
+    def status(self, key, dtype='float64'):
+        try:
+            return self._status[key, dtype]
+        except KeyError:
+            column = numpy.fromiter(
+                (s.status[key] for s in self.snapshots),
+                dtype=dtype,
+                count=self.count
+            )
+            self._status[key, dtype] = column
+            return column
+
+    def metric(self, metric):
+        try:
+            return self._metrics[metric]
+        except KeyError:
+            key, divisor = METRIC_COLUMNS.get(metric, METRIC_COLUMNS['func_ratio'])
+            if metric == 'func_added':
+                column = (self.now - self.status(key)) / 86400.0
+            elif divisor is not None:
+                column = self.status(key) / divisor
+            else:
+                column = self.status(key)
+            self._metrics[metric] = column
+            return column
+
+    def select(self, filter1, filter2, keep):
+        """Returns the indices select_candidates() would give the snapshots
+        of, beyond the first keep of the ascending sort and highest first"""
+        if self.count - keep <= 0:
+            return numpy.zeros(0, dtype='intp')
+        # lexsort is stable, so ties stay in library order like sorted()
+        order = numpy.lexsort((self.metric(filter2), self.metric(filter1)))
+        return order[keep:][::-1]
+
+    def rule_codes(self, rule_sets):
+        """Numbers the distinct specific rule sets, returns the code of each
+        snapshot and the rule set of each code"""
+        codes = {}
+        distinct = []
+        column = numpy.empty(self.count, dtype='int32')
+        for n, ruleset in enumerate(rule_sets):
+            # torrents with the same trackers and label share a RuleSet
+            code = codes.get(id(ruleset))
+            if code is None:
+                code = codes[id(ruleset)] = len(distinct)
+                distinct.append(ruleset)
+            column[n] = code
+        return column, distinct
+
+    def crossing_times(self, metric, threshold, seeding):
+        """Vector form of policy.crossing_time() for one condition"""
+        values = self.metric(metric)
+        if metric == 'func_added':
+            beyond = values > threshold
+        elif metric == 'func_seed_time':
+            # paused or queued torrents don't seed
+            beyond = (values > threshold) | ~seeding
+        else:
+            # cannot be predicted, check again next cycle
+            return numpy.full(self.count, self.now)
+        with numpy.errstate(invalid='ignore'):
+            times = self.now + (threshold - values) / (1/86400.0) + 1.0
+        return numpy.where(beyond, numpy.inf, times)
+
+    def decide(self, rule_sets, spec, indices):
+        """Decides on the snapshots at indices, like policy.decide() on each.
+
+        rule_sets holds the RuleSet of every snapshot. Returns the
+        decisions and errors by torrent id.
+        """
+        decisions = {}
+        errors = {}
+        if not spec.enabled:
+            for k in indices:
+                decisions[self.snapshots[k].id] = NO_DECISION
+            return decisions, errors
+
+        n = self.count
+        failed = numpy.zeros(n, dtype=bool)
+        message = numpy.empty(n, dtype=object)
+
+        # general rules, for torrents without specific ones
+        filter_1 = self.metric(spec.filter) <= spec.min_val
+        filter_2 = self.metric(spec.filter2) >= spec.max_val2
+        if spec.rule_1 and spec.rule_2:
+            if spec.sel_func == 'and':
+                remove_cond = filter_1 & filter_2
+            elif spec.sel_func == 'or':
+                remove_cond = filter_1 | filter_2
+            else:
+                remove_cond = numpy.zeros(n, dtype=bool)
+                failed[:] = True
+                message[:] = 'Unknown logical operator {}'.format(spec.sel_func)
+        elif spec.rule_1:
+            remove_cond = filter_1.copy()
+        elif spec.rule_2:
+            remove_cond = filter_2.copy()
+        else:
+            remove_cond = numpy.zeros(n, dtype=bool)
+
+        finished = self.status('is_finished', 'bool')
+        paused = self.status('paused', 'bool')
+        seeding = finished & ~paused
+        seedtime = self.status('seeding_time') / 3600.0
+
+        # the specific rules of each rule set
+        codes, distinct = self.rule_codes(rule_sets)
+        has_rules = numpy.zeros(n, dtype=bool)
+        deadline = numpy.full(n, numpy.inf)
+        for code, ruleset in enumerate(distinct):
+            if not ruleset:
+                continue
+            mask = codes == code
+            has_rules |= mask
+            failed[mask] = False
+            if ruleset.error is not None:
+                failed[mask] = True
+                message[mask] = ruleset.error
+            cond = numpy.ones(mask.sum(), dtype=bool)
+            for metric, threshold in ruleset.all_of:
+                cond &= self.metric(metric)[mask] >= threshold
+            for metric, threshold in ruleset.any_of:
+                cond |= self.metric(metric)[mask] >= threshold
+            remove_cond[mask] = cond
+            for rule in ruleset.rules:
+                deadline[mask] = numpy.minimum(deadline[mask], self.crossing_times(rule[1], rule[2], seeding)[mask])
+
+        # conditions of the general rules, for unfinished torrents
+        general = ~has_rules & ~finished
+        if spec.rule_1:
+            deadline[general] = numpy.minimum(deadline[general], self.crossing_times(spec.filter, spec.min_val, seeding)[general])
+        if spec.rule_2:
+            deadline[general] = numpy.minimum(deadline[general], self.crossing_times(spec.filter2, spec.max_val2, seeding)[general])
+        for threshold in (spec.seedtime_limit / 24.0, spec.seedtime_pause / 24.0):
+            deadline[finished] = numpy.minimum(deadline[finished], self.crossing_times('func_seed_time', threshold, seeding)[finished])
+
+        unfinished_acted = ~finished & remove_cond
+        seed_ok = finished & (~has_rules | remove_cond)
+        over_limit = seedtime > spec.seedtime_limit
+        seed_remove = seed_ok & over_limit & (not spec.pause_seed)
+        seed_pause = seed_ok & ~over_limit & (seedtime > spec.seedtime_pause) & ~paused
+
+        for k in indices:
+            k = int(k)
+            torrent_id = self.snapshots[k].id
+            if failed[k]:
+                errors[torrent_id] = message[k]
+            elif unfinished_acted[k]:
+                if spec.remove:
+                    decisions[torrent_id] = Decision(ACT_REMOVE, None)
+                else:
+                    decisions[torrent_id] = Decision(None if paused[k] else ACT_PAUSE, None)
+            elif seed_remove[k]:
+                decisions[torrent_id] = Decision(ACT_SEED_REMOVE, None)
+            elif seed_pause[k]:
+                decisions[torrent_id] = Decision(ACT_SEED_PAUSE, None)
+            else:
+                decisions[torrent_id] = Decision(None, float(deadline[k]))
+        return decisions, errors
@@ -48,10 +48,21 @@ from deluge.plugins.pluginbase import CorePluginBase
 import deluge.component as component
 import deluge.configmanager
 from deluge.core.rpcserver import export
-from .mediaserver import Mediaserver
-from twisted.internet import reactor
-from twisted.internet.task import LoopingCall, deferLater
+from .mediaserver import Mediaserver, AsyncMediaserver, MediaserverRegistry, create_pool
+from . import webhook
+from . import columnar
+from .policy import _age_in_days, compile_policy, decide, evaluate_shard
+from .policy import ACT_REMOVE, ACT_PAUSE, ACT_SEED_REMOVE, ACT_SEED_PAUSE
+from .policy import take_snapshot, MetricCache, select_candidates
+from .policy import NO_RULES, EvalState
+from twisted.internet import reactor, defer
+from twisted.python.failure import Failure
+from twisted.internet.task import LoopingCall, Cooperator, deferLater
 
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import multiprocessing
+import threading
 import time
 import logging
 log = logging.getLogger(__name__)
@@ -74,38 +85,71 @@ DEFAULT_PREFS = {
     'tracker_rules': {},
     'label_rules': {},
     'rule_1_enabled': True,
-    'rule_2_enabled': True
+    'rule_2_enabled': True,
+    'full_scan_interval': 6.0,
+    'queue_page_size': 250,
+    'queue_fanout': 4,
+    'queue_ttl': 300,
+    'queue_lookup_limit': 5,
+    'webhook_port': 0,
+    'webhook_interface': '127.0.0.1',
+    'webhook_token': '',
+    'webhook_sync_interval': 6.0,
+    'mediaservers': [],
+    'scan_chunk_size': 500,
+    'scan_slice_budget': 0.05,
+    'eval_processes': 0,
+    'eval_shard_size': 2000,
+    'eval_engine': 'python',
+    'seedtime_limit': 48.0,
+    'seedtime_pause': 24.0,
+    'pause_seed': False
 }
 
-def _get_ratio(i_t):
-    (i, t) = i_t
-    log.debug("Get ratio: i = {}, t = {}".format(i,t))
-    return t.get_ratio()
-
-def _age_in_days(i_t):
-    (i, t) = i_t
-    log.debug("Age in hours called: i = {}, t = {}".format(i,t))
-    now = time.time()
-    added = t.get_status(['time_added'])['time_added']
-    log.debug("Now = {}, added = {}".format(now,added))
-    age_in_days = (now - added)/86400.0 # age in hours
-    log.debug("Returning age: {}".format(age_in_days))
-    return age_in_days
-
-
-# Add key label also to get_remove_rules():141
-filter_funcs = {
-    'func_ratio': _get_ratio,
-    'func_added': _age_in_days,
-    'func_seed_time': lambda p: p[1].get_status(['seeding_time'])['seeding_time'] / 86400.0,
-    'func_seeders': lambda p: p[1].get_status(['total_seeds'])['total_seeds'],
-    'func_availability': lambda p: p[1].get_status(['distributed_copies'])['distributed_copies']
-}
+# Media servers of configs without a mediaservers list: type and the label
+# of the torrents they grab, all on server_url
+LEGACY_MEDIASERVERS = (
+    ('sonarr', 'tv-sonarr'),
+    ('lidarr', 'lidarr'),
+    ('radarr', 'radarr')
+)
+
+# Shortest time in seconds between two cycles started by seed time deadlines
+DEADLINE_MIN_GAP = 60.0
+
+# A cycle started by a deadline scans the whole library, so deadlines are
+# gathered for this fraction of the check interval and handled together
+DEADLINE_WINDOW = 0.25
+
+# Events after which a torrent has to be evaluated again
+DIRTY_EVENTS = (
+    'TorrentAddedEvent',
+    'TorrentFinishedEvent',
+    'TorrentStateChangedEvent'
+)
+
+def deferred_from_future(future):
+    """Returns a Deferred firing on the reactor with the result of a
+    concurrent.futures future"""
+    d = defer.Deferred()
+
+    def done(future):
+        try:
+            result = future.result()
+        except Exception:
+            reactor.callFromThread(d.errback, Failure())
+        else:
+            reactor.callFromThread(d.callback, result)
+    future.add_done_callback(done)
+    return d
+
+
+class CycleState(object):
+    """Values shared by the stages of one do_remove cycle"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
 
-sel_funcs = {
-    'and': lambda tup: tup[0] and tup[1],
-    'or': lambda tup: tup[0] or tup[1]
-}
 
 class Core(CorePluginBase):
 
@@ -120,51 +164,294 @@ class Core(CorePluginBase):
             "autoremoveplusstates.conf",
             {}
         )
+        self.queue_index = deluge.configmanager.ConfigManager(
+            "autoremoveplusqueues.conf",
+            {}
+        )
 
         # Safe after loading to have a default configuration if no gtkui
         self.config.save()
         self.torrent_states.save()
 
+        self.build_policy()
+
         # it appears that if the plugin is enabled on boot then it is called
         # before the torrents are properly loaded and so do_remove receives an
         # empty list. So we must listen to SessionStarted for when deluge boots
         #  but we still have apply_now so that if the plugin is enabled
         # mid-program do_remove is still run
+        self.cycle_stats = {}
+        self.eval_states = {}
+        self.dirty = set()
+        self.deadlines = []
+        self.deadline_call = None
+        self.last_cycle = 0.0
+        self.last_full_scan = 0.0
+        self.removing = False
+        self.labels_enabled = None
+        event_manager = component.get("EventManager")
+        for event in DIRTY_EVENTS:
+            event_manager.register_event_handler(event, self.on_torrent_changed)
+        event_manager.register_event_handler("TorrentRemovedEvent", self.on_torrent_removed)
+
         self.looping_call = LoopingCall(self.do_remove)
         deferLater(reactor, 5, self.start_looping)
-        try:
-          apikey_sonarr = self.config['api_sonarr']
-          apikey_radarr = self.config['api_radarr']
-          apikey_lidarr = self.config['api_lidarr']
-          use_sonarr    = self.config['enable_sonarr']
-          use_radarr    = self.config['enable_radarr']
-          use_lidarr    = self.config['enable_lidarr']
-          server        = self.config['server_url']
-        except KeyError as e:
-          log.warning("Unable to read server config, so disabling sonarr/radarr/lidarr for now. Missing key: {}".format(e))
-          use_sonarr    = False
-          use_radarr    = False
-          use_lidarr    = False
-          apikey_sonarr = None
-          apikey_radarr = None
-          apikey_lidarr = None
-          server        = None
-          
-        log.info("Server config: Sonarr: enabled={},key={}, Radarr: enabled={}, key={}, Lidarr: enabled={}, key={}, Server: url={}".format(use_sonarr,apikey_sonarr,use_radarr,apikey_radarr,use_lidarr,apikey_lidarr,server))
-        
-        self.sonarr = Mediaserver(server,apikey_sonarr,'sonarr')
-        self.lidarr = Mediaserver(server,apikey_lidarr,'lidarr')
-        self.radarr = Mediaserver(server,apikey_radarr,'radarr')
-        
-        #self.mediaServer ={
-        #'tv-sonarr'     : sonarr,
-        #'lidarr'        : lidarr,
-        #'radarr'        : radarr
-        #}
+        # cycles run in slices, between them the reactor serves everyone else
+        self.cooperator = Cooperator(
+            terminationPredicateFactory=self.slice_terminator,
+            scheduler=lambda f: reactor.callLater(0, f)
+        )
+        # started on the first cycle that evaluates in worker processes
+        self.process_pool = None
+        # http requests run on their own threads, never on the reactor, with
+        # a thread per instance so all queues can sync at the same time
+        configs = self.get_mediaserver_configs()
+        self.pool = create_pool(max(4, len(configs)))
+        self.mediaserver_keys = {}
+        self.mediaservers = self.build_mediaservers(configs)
+
+        # start from the queues saved before the restart and check them in
+        # the background, so the first cycle doesn't wait on the servers
+        self.saved_queue_versions = {}
+        self.load_queues()
+
+        # webhooks keep the queues current, a full sync once in a while
+        # catches events that were missed
+        self.webhook_port = None
+        self.sync_call = LoopingCall(self.sync_queues)
+        self.start_webhook()
+        if not self.sync_call.running:
+            self.sync_queues()
         
     def disable(self):
         if self.looping_call.running:
             self.looping_call.stop()
+        self.cooperator.stop()
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=False)
+            self.process_pool = None
+        self.stop_webhook()
+        self.save_queues()
+        if self.deadline_call is not None and self.deadline_call.active():
+            self.deadline_call.cancel()
+        # stop() joins the worker threads, which may be waiting on a slow
+        # server, so it runs on a daemon thread instead of the reactor
+        stopper = threading.Thread(target=self.pool.stop, name='autoremoveplus-pool-stop')
+        stopper.daemon = True
+        stopper.start()
+        event_manager = component.get("EventManager")
+        for event in DIRTY_EVENTS:
+            event_manager.deregister_event_handler(event, self.on_torrent_changed)
+        event_manager.deregister_event_handler("TorrentRemovedEvent", self.on_torrent_removed)
+
+    def get_mediaserver_configs(self):
+        """Returns the media server instances of the config.
+
+        Without a mediaservers list, the single sonarr, lidarr and radarr of
+        older configs are used, all on server_url with their fixed labels.
+        """
+        if self.config['mediaservers']:
+            return self.config['mediaservers']
+        server = self.config.config.get('server_url')
+        if not server:
+            log.warning("No server_url in config, so disabling sonarr/radarr/lidarr for now")
+        return [{
+            'name'   : type,
+            'type'   : type,
+            'url'    : server,
+            'apikey' : self.config.config.get('api_' + type),
+            'labels' : [label],
+            'enabled': bool(server and self.config.config.get('enable_' + type))
+        } for (type, label) in LEGACY_MEDIASERVERS]
+
+    def build_mediaservers(self, configs, previous=None):
+        """Creates the registry of media server instances.
+
+        Instances of the previous registry whose name, type, url, key and
+        api are unchanged are carried over with their queue, circuit breaker
+        and session, only the labels and enabled flag are taken from configs.
+        """
+        page_size = self.config['queue_page_size']
+        fanout = self.config['queue_fanout']
+        lookup_limit = self.config['queue_lookup_limit']
+        registry = MediaserverRegistry()
+        keys = {}
+        for conf in configs:
+            try:
+                key = (
+                    conf.get('name') or conf['type'],
+                    conf['type'],
+                    conf['url'],
+                    conf.get('apikey'),
+                    conf.get('api_version'),
+                    conf.get('endpoint')
+                )
+                old = previous.get(key[0]) if previous is not None else None
+                if old is not None and self.mediaserver_keys.get(key[0]) == key:
+                    async_server, server = old, old.server
+                    server.page_size = page_size
+                    server.fanout = fanout
+                    server.lookup_limit = lookup_limit
+                else:
+                    server = Mediaserver(
+                        conf['url'],
+                        conf.get('apikey'),
+                        conf['type'],
+                        page_size,
+                        fanout,
+                        lookup_limit,
+                        api_version=conf.get('api_version'),
+                        endpoint=conf.get('endpoint'),
+                        name=conf.get('name')
+                    )
+                    async_server = AsyncMediaserver(server, self.pool)
+                registry.add(async_server, conf.get('labels', []), conf.get('enabled', True))
+                keys[key[0]] = key
+            except Exception as e:
+                log.error("Skipping media server {}: {}".format(conf.get('name') or conf.get('type'), e))
+                continue
+            log.info("Media server {}: type={}, url={}, enabled={}, labels={}".format(
+                server.name, server.type, server.server, conf.get('enabled', True), conf.get('labels', [])))
+        # sessions of instances that were dropped or replaced
+        if previous is not None:
+            for old in previous:
+                if registry.get(old.name) is not old:
+                    old.server.session.close()
+        self.mediaserver_keys = keys
+        return registry
+
+    def slice_terminator(self):
+        """Returns a predicate that ends a slice of a cycle after
+        scan_chunk_size torrents or scan_slice_budget seconds"""
+        chunk_size = max(1, self.config['scan_chunk_size'])
+        deadline = time.time() + self.config['scan_slice_budget']
+        steps = [0]
+
+        def done():
+            steps[0] += 1
+            return steps[0] >= chunk_size or time.time() >= deadline
+        return done
+
+    def schedule_deadline(self):
+        """Starts a cycle when the first torrent crosses a threshold"""
+        # drop deadlines that were moved or whose torrent is gone
+        while self.deadlines:
+            deadline, torrent_id = self.deadlines[0]
+            state = self.eval_states.get(torrent_id)
+            if state is not None and state.next_check == deadline:
+                break
+            heapq.heappop(self.deadlines)
+        else:
+            if self.deadline_call is not None and self.deadline_call.active():
+                self.deadline_call.cancel()
+            return
+
+        # several torrents crossing in a row are handled by one cycle
+        gap = max(DEADLINE_MIN_GAP, self.config['interval'] * 3600.0 * DEADLINE_WINDOW)
+        at = max(self.deadlines[0][0], self.last_cycle + gap)
+        # no need for an extra cycle when the regular one comes first
+        call = getattr(self.looping_call, 'call', None)
+        if call is not None and call.active() and call.getTime() <= at:
+            if self.deadline_call is not None and self.deadline_call.active():
+                self.deadline_call.cancel()
+            return
+        delay = max(at - time.time(), 0.0)
+        if self.deadline_call is not None and self.deadline_call.active():
+            self.deadline_call.reset(delay)
+        else:
+            self.deadline_call = reactor.callLater(delay, self.on_deadline)
+        log.debug("AutoRemovePlus: next deadline in {:.0f} s, {} scheduled".format(delay, len(self.deadlines)))
+
+    def start_webhook(self):
+        port = self.config['webhook_port']
+        if not port:
+            return
+        servers = dict((server.name, server) for server in self.mediaservers.active())
+        try:
+            self.webhook_port = webhook.listen(
+                servers,
+                port,
+                self.config['webhook_interface'],
+                self.config['webhook_token'] or None
+            )
+        except Exception as e:
+            log.error("AutoRemovePlus: cannot listen for webhooks on port {}: {}".format(port, e))
+            return
+        self.sync_call.start(self.config['webhook_sync_interval'] * 3600.0)
+
+    def restart_sync(self):
+        """Listens for webhooks again and syncs the queues of the media servers"""
+        self.start_webhook()
+        if not self.sync_call.running:
+            self.sync_queues()
+
+    def stop_webhook(self):
+        """Stops the webhook listener, the returned Deferred fires once the
+        port is closed"""
+        if self.sync_call.running:
+            self.sync_call.stop()
+        if self.webhook_port is None:
+            return defer.succeed(None)
+        port, self.webhook_port = self.webhook_port, None
+        return defer.maybeDeferred(port.stopListening)
+
+    def queue_max_age(self):
+        """Returns how old a cached media server queue may be, in seconds"""
+        if self.webhook_port is not None:
+            return self.config['webhook_sync_interval'] * 3600.0
+        return self.config['queue_ttl']
+
+    def sync_queues(self):
+        """Downloads the queues of all enabled media servers in parallel"""
+        deferreds = []
+        for server in self.mediaservers.active():
+            d = server.get_queue()
+            d.addErrback(lambda f, n=server.name: log.error("Cannot sync {} queue: {}".format(n, f.getErrorMessage())))
+            deferreds.append(d)
+        return defer.DeferredList(deferreds).addCallback(lambda _: self.save_queues())
+
+    def load_queues(self):
+        """Loads the saved queues of the media servers that hold none yet"""
+        for server in self.mediaservers:
+            if server.server.queue is not None:
+                continue
+            data = self.queue_index.config.get(server.name)
+            if not data:
+                continue
+            try:
+                server.server.import_queue(data)
+            except Exception as e:
+                log.warning("Cannot load saved {} queue: {}".format(server.name, e))
+                continue
+            self.saved_queue_versions[server.name] = server.queue_version
+
+    def save_queues(self):
+        """Writes the queues changed since the last save to disk, by syncs
+        as well as by webhook events and deletes"""
+        changed = False
+        for server in self.mediaservers:
+            version = server.queue_version
+            if version == self.saved_queue_versions.get(server.name):
+                continue
+            data = server.server.export_queue()
+            if data is None:
+                continue
+            self.queue_index[server.name] = data
+            self.saved_queue_versions[server.name] = version
+            changed = True
+        if changed:
+            self.queue_index.save()
+
+    def on_deadline(self):
+        log.info("AutoRemovePlus: seed time deadline reached")
+        self.do_remove()
+
+    def on_torrent_changed(self, torrent_id, *args):
+        self.dirty.add(torrent_id)
+
+    def on_torrent_removed(self, torrent_id):
+        self.dirty.discard(torrent_id)
+        self.eval_states.pop(torrent_id, None)
 
     def update(self):
         pass
@@ -179,15 +466,52 @@ class Core(CorePluginBase):
         for key in list(config.keys()):
             self.config[key] = config[key]
         self.config.save()
+        self.build_policy()
+        # the remove policy changed, so nothing learned so far holds
+        self.eval_states = {}
+        self.deadlines = []
+        # worker processes are started again with the new eval_processes
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=False)
+            self.process_pool = None
+        # media servers may have been added, changed or switched on or off
+        self.save_queues()
+        configs = self.get_mediaserver_configs()
+        self.pool.adjustPoolsize(maxthreads=max(4, len(configs)))
+        self.mediaservers = self.build_mediaservers(configs, self.mediaservers)
+        self.load_queues()
+        self.stop_webhook().addCallback(lambda _: self.restart_sync())
         if self.looping_call.running:
             self.looping_call.stop()
         self.looping_call.start(self.config['interval'] * 3600.0)
 
+    def build_policy(self):
+        """Compiles the remove policy of the config. Cycles started from
+        now on use the new one, a running cycle keeps its own."""
+        try:
+            policy = compile_policy(self.config.config, DEFAULT_PREFS)
+        except Exception as e:
+            log.error("Error reading config: {}".format(e))
+            if getattr(self, 'policy', None) is not None:
+                return
+            policy = compile_policy({}, DEFAULT_PREFS)
+        self.policy = policy
+
     @export
     def get_config(self):
         """Returns the config dictionary"""
         return self.config.config
 
+    @export
+    def get_cycle_stats(self):
+        """Returns counters gathered during the last do_remove cycle"""
+        return self.cycle_stats
+
+    @export
+    def get_server_status(self):
+        """Returns the circuit breaker state of each media server"""
+        return dict((server.name, server.breaker.status()) for server in self.mediaservers)
+
     @export
     def get_remove_rules(self):
         return {
@@ -256,92 +580,292 @@ class Core(CorePluginBase):
         else:
             return True
 
-    def get_torrent_rules(self, id, torrent, tracker_rules, label_rules):
-        
-        total_rules = []
+    @defer.inlineCallbacks
+    def remove_from_servers(self, removals):
+        """Removes torrents through the media server queues they came from.
+
+        removals maps each server name to the (hash, name) of its torrents. The
+        queue ids of all of them are looked up together, so the server can
+        pick between a targeted search and one full queue download, and
+        deleted in one batch. Returns True if any removal succeeded.
+        """
+        changed = False
+        for server in self.mediaservers:
+            torrents = removals.get(server.name)
+            if not torrents:
+                continue
+            # an unreachable server only holds up its own torrents
+            if server.breaker.blocked():
+                log.warning("Skipping removal of {} torrents through {}: server unreachable".format(len(torrents),server.name))
+                continue
+            try:
+                items = yield server.lookup([hash for (hash, name) in torrents], self.queue_max_age())
+            except Exception as e:
+                log.error("Cannot get {} queue: {}".format(server.name, e))
+                continue
+            ids = {}
+            for hash, name in torrents:
+                if hash in items:
+                    ids[hash] = str(items[hash].get('id'))
+                else:
+                    log.warning("Could not find torrent {} in {} queue:{}".format(name,server.name,hash))
+            if not ids:
+                continue
+            try:
+                results = yield server.delete_queueitems(list(ids.values()))
+            except Exception as e:
+                log.error("Error removing {} torrents from {} queue: {}".format(len(ids),server.name,e))
+                continue
+            for hash, name in torrents:
+                if hash in ids:
+                    removed = results.get(ids[hash], False)
+                    changed = changed or removed
+                    log.info("Removal request for {}/{} for torrent {}: => {}".format(ids[hash],hash,name,removed))
+        return changed
 
+    def get_labels(self, torrent_ids):
+        """Returns the label of every torrent, fetched in one go from the
+        Label plugin, or None if the plugin cannot be reached"""
         try:
-          for t in torrent.trackers:
-              for name, rules in list(tracker_rules.items()):
-                  log.debug("Get_torrent_rules: processing name = {}, rules = {}, url = {}, find = {} ".format(name, rules,t['url'],t['url'].find(name.lower())))
-                  if(t['url'].find(name.lower()) != -1):
-                      for rule in rules:
-                          total_rules.append(rule)
+            plugin = component.get("CorePlugin.Label")
         except Exception as e:
-          log.warning("Get_torrent_rules: Exception with getting torrent rules for {}: {}".format(id,e))
-          return total_rules
-          
-        if label_rules:
+            log.warning("Cannot reach Label plugin, labels will not be checked: {}".format(e))
+            return None
+        try:
+            torrent_labels = plugin.torrent_labels
+        except AttributeError:
+            # older Label plugins only offer the per torrent status getter
+            return dict((i, plugin._status_get_label(i)) for i in torrent_ids)
+        return dict((i, torrent_labels.get(i) or '') for i in torrent_ids)
+
+    def scan_torrents(self, cycle):
+        """Sorts the torrents of a cycle into ignored ones and snapshots of
+        the ones the remove rules apply to, one torrent per step"""
+        torrentmanager = cycle.torrentmanager
+        torrent_ids = cycle.torrent_ids
+        labels = cycle.labels
+        labels_enabled = cycle.labels_enabled
+        dirty = cycle.dirty
+        policy = cycle.policy
+        rulebook = policy.rulebook
+        keys = cycle.keys
+        now = cycle.now
+        torrents = cycle.torrents
+        ignored_torrents = cycle.ignored_torrents
+
+        # relevant torrents to us exist and are finished
+        for i in torrent_ids:
+            yield
+            t = torrentmanager.torrents.get(i, None)
+            if t is None:
+                continue
+
             try:
-                # get label string
-                label_str = component.get(
-                    "CorePlugin.Label"
-                )._status_get_label(id)
-
-                # if torrent has labels check them
-                labels = [label_str] if len(label_str) > 0 else []
-
-                for label in labels:
-                    if label in label_rules:
-                        for rule in label_rules[label]:
-                            total_rules.append(rule)
+                ignored = self.torrent_states[i]
+            except KeyError as e:
+                ignored = False
+
+            if ignored:
+                ignored_torrents.append((i, t))
+                continue
+
+            label_str = labels.get(i, '')
+            state = self.eval_states.get(i)
+
+            # there are no label or tracker change events, so compare with
+            # the ones the torrent was classified with
+            trackers = tuple(tracker['url'] for tracker in t.trackers)
+            if state is None or i in dirty or state.label != label_str or state.trackers != trackers:
+                cycle.classified += 1
+                ex_torrent = False
+
+                # check if trackers in exempted tracker list
+                ex_tracker = policy.tracker_matcher.search_any(trackers)
+                if ex_tracker is not None:
+                    log.debug("Found exempted tracker: %s" % (ex_tracker))
+                    ex_torrent = True
+
+                # check if labels in exempted label list if Label plugin is enabled
+                if labels_enabled and not ex_torrent and label_str:
+                    ex_label = policy.label_matcher.search(label_str)
+                    if ex_label is not None:
+                        log.debug("Found exempted label: %s" % (ex_label))
+                        ex_torrent = True
+
+                ruleset = NO_RULES
+                if not ex_torrent:
+                    try:
+                        ruleset = rulebook.lookup(t.trackers, label_str if labels_enabled else '')
+                    except Exception as e:
+                        log.warning("Exception with getting torrent rules for {}: {}".format(i, e))
+                log.debug("Specific rules for {}: {}".format(i, ruleset.rules))
+                state = EvalState(label_str, trackers, ex_torrent, ruleset)
+                self.eval_states[i] = state
+
+            # if torrent tracker or label in exemption list
+            # insert in the ignored torrents list
+            if state.exempt:
+                ignored_torrents.append((i, t))
+            else:
+                torrents.append(take_snapshot(i, t, keys, label_str, now))
+
+    def act_on_candidates(self, cycle, candidates):
+        """Removes or pauses the removal candidates of a cycle, one torrent
+        per step. Decisions made in worker processes are taken from the
+        cycle, the others are made here."""
+        torrentmanager = cycle.torrentmanager
+        spec = cycle.spec
+        metric_cache = cycle.metric_cache
+        removals = cycle.removals
+
+        # remove or pause these torrents
+        for s in candidates:
+            yield
+            i = s.id
+            t = torrentmanager.torrents.get(i, None)
+            state = self.eval_states.get(i)
+            # removed, or the config changed, since the scan
+            if t is None or state is None:
+                continue
+            name = s.status['name']
+            log.debug("Now processing name = {}, type = {}".format(name,type(name)))
+            # check if free disk space below minimum
+            if self.check_min_space():
+                return  # stop here, we have enough space
+
+            # nothing to do last time, and no event or threshold changed that
+            if cycle.now < state.next_check:
+                cycle.skipped += 1
+                continue
+
+            try:
+                if i in cycle.errors:
+                    raise Exception(cycle.errors[i])
+                decision = cycle.decisions.get(i)
+                if decision is None:
+                    decision = decide(s, state.ruleset, spec, metric_cache)
+                seedtime = s.status['seeding_time']/3600 #seed time in hours
+                ratio = s.status['ratio']
+                hash = s.status['hash'].upper()
             except Exception as e:
-                log.warning("Cannot obtain torrent label for {}: {}".format(id,e))
-        log.debug("Get_torrent_rules: returning rules for {}: {}".format(id,total_rules))
-        return total_rules
+                log.error("Error with torrent: {}".format(e))
+                continue
+
+            action = decision.action
+            if not s.status['is_finished']:
+                label_str = s.label
+                if cycle.labels_enabled and not label_str:
+                    log.warning("Torrent: {}, label = {}".format(name,label_str))
+                log.debug("Processing unfinished torrent {}, label = {}".format(name,label_str))
+                if action == ACT_REMOVE:
+                    # communicate with media servers and remove from their api
+                    server = self.mediaservers.route(label_str)
+                    if server is None:
+                        log.debug("No matching label {}for torrent {}, or queue not returned from server. Hash = {}".format(label_str,name,hash))
+                    elif self.mediaservers.is_enabled(server): # remove using the server api and blacklist
+                        removals.setdefault(server.name, []).append((hash, name))
+                    else: # remove using local method
+                        result = self.remove_torrent(torrentmanager, i, cycle.remove_data)
+                        log.info("AutoRemovePlus: removing unfinished torrent {} with data using internal method: {}".format(name,result))
+                elif action == ACT_PAUSE:
+                    log.info("AutoRemovePlus: Pausing torrent {} due to ratio = {} and age = {}".format(name, ratio, _age_in_days(s)))
+                    self.pause_torrent(t)
+
+            else: # is finished
+                log.debug("Fin.: {}, seed time:{}/{}, ratio: {}, spec. rules = {}, action = {}, hash = {}".format(name,seedtime,spec.seedtime_limit,ratio,state.ruleset.rules,action,hash))
+                if action == ACT_SEED_REMOVE:
+                    #Sending False to remove data because it is probably not intended for completed torrents
+                    self.remove_torrent(torrentmanager, i, False)
+                    cycle.changed = True
+                    log.info("AutoRemovePlus: removing torrent from seed: {} due to seed time = {}/{} h".format(name,seedtime,spec.seedtime_limit))
+                elif action == ACT_SEED_PAUSE:
+                    try:
+                        self.pause_torrent(t)
+                        log.info("AutoRemovePlus: pausing finished torrent {} with seedtime = {}/{} h, ratio = {}, rules = {}".format(name,seedtime,spec.seedtime_pause,ratio,state.ruleset.rules))
+                    except Exception as e:
+                        log.warning("AutoRemovePlus: error with pausing torrent: {}".format(name))
+
+            if decision.next_check is not None:
+                state.next_check = decision.next_check
+                # unpredictable metrics are left to the regular interval
+                if cycle.now < state.next_check < float('inf'):
+                    heapq.heappush(self.deadlines, (state.next_check, i))
+
+    def evaluate_in_processes(self, cycle, candidates):
+        """Decides on the candidates in the process pool, in shards of
+        eval_shard_size torrents. The returned Deferred fires once the
+        decisions and errors of all shards are on the cycle."""
+        # candidates skipped by the action loop are not worth sending
+        items = []
+        for s in candidates:
+            state = self.eval_states.get(s.id)
+            if state is not None and cycle.now >= state.next_check:
+                items.append((s, state.ruleset))
+        if not items:
+            return defer.succeed(None)
+
+        if self.process_pool is None:
+            # a fresh interpreter, not a fork of the threads of deluged
+            self.process_pool = ProcessPoolExecutor(
+                max_workers=self.config['eval_processes'],
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        size = max(1, self.config['eval_shard_size'])
+        deferreds = []
+        for n in range(0, len(items), size):
+            future = self.process_pool.submit(evaluate_shard, cycle.spec, items[n:n + size])
+            deferreds.append(deferred_from_future(future))
+        log.info("AutoRemovePlus: evaluating {} candidates in {} shards".format(len(items), len(deferreds)))
+
+        def collect(results):
+            for decisions, errors, stats in results:
+                cycle.decisions.update(decisions)
+                cycle.errors.update(errors)
+                cycle.metric_cache.hits += stats['hits']
+                cycle.metric_cache.misses += stats['misses']
+                cycle.metric_cache.expensive += stats['expensive']
+                cycle.metric_cache.avoided += stats['avoided']
+
+        d = defer.gatherResults(deferreds, consumeErrors=True)
+        return d.addCallback(collect)
 
     # we don't use args or kwargs it just allows callbacks to happen cleanly
     def do_remove(self, *args, **kwargs):
+        # the interval, a deadline or set_config can each start a cycle
+        if self.removing:
+            log.info("AutoRemovePlus: previous check still running, skipping")
+            return
+        self.removing = True
+
+        def done(result):
+            self.removing = False
+
+        # detached from the LoopingCall, so restarting it in set_config
+        # while a cycle waits on a media server cannot leave a second timer
+        d = self.remove_cycle()
+        d.addErrback(lambda f: log.error("AutoRemovePlus: error in remove cycle: {}".format(f.getTraceback())))
+        d.addBoth(done)
+
+    @defer.inlineCallbacks
+    def remove_cycle(self):
         log.info("AutoRemovePlus: check do_remove")
         
-        try:
-          max_seeds = self.config['max_seeds']
-          count_exempt = self.config['count_exempt']
-          remove_data = self.config['remove_data']
-          exemp_trackers = self.config['trackers']
-          exemp_labels = self.config['labels']
-          min_val = self.config['min']
-          max_val2 = self.config['min2']
-          remove = self.config['remove']
-          enabled = self.config['enabled']
-          tracker_rules = self.config['tracker_rules']
-          rule_1_chk = self.config['rule_1_enabled']
-          rule_2_chk = self.config['rule_2_enabled']
-          seedtime_limit = self.config['seedtime_limit']
-          seedtime_pause = self.config['seedtime_pause']
-          always_pause_seed = self.config['pause_seed']
-          labels_enabled = False
-          use_sonarr = self.config['enable_sonarr']
-          use_radarr = self.config['enable_radarr']
-          use_lidarr = self.config['enable_lidarr']
-          
-          sonarr_list = self.sonarr.get_queue() if use_sonarr else {}
-          radarr_list = self.radarr.get_queue() if use_radarr else {}
-          lidarr_list = self.lidarr.get_queue() if use_lidarr else {}
-          
-          #prevent hit & run
-          seedtime_pause = seedtime_pause if seedtime_pause > 20.0 else 20.0
-          seedtime_limit = seedtime_limit if seedtime_limit > 24.0 else 24.0
-          
-          log.info("Using sonarr: {}, radarr: {}, lidarr: {}".format(use_sonarr,use_radarr,use_lidarr))
-          log.info("Size of lists: sonarr:{}, lidarr:{}, radarr:{}".format(len(sonarr_list),len(lidarr_list),len(radarr_list)))
-                   
-          #response = self.sonarr.delete_queueitem('1771649588')          
-          #log.info("Delete response:{}".format(response))
-          
-        except Exception as e:
-          log.error("Error reading config: {}".format(e))
-          return False
-        
+        # the policy is swapped whole by set_config, this cycle keeps its own
+        policy = self.policy
+        spec = policy.spec
+        max_seeds = policy.max_seeds
+        count_exempt = policy.count_exempt
+        remove_data = policy.remove_data
+        labels_enabled = False
+        log.info("Using media servers: {}".format(', '.join(server.name for server in self.mediaservers.active())))
+
         if 'Label' in component.get(
             "CorePluginManager"
         ).get_enabled_plugins():
             labels_enabled = True
-            label_rules = self.config['label_rules']
         else:
             log.warning("WARNING! Label plugin not active")
             log.debug("No labels will be checked for exemptions!")
-            label_rules = []
 
         # Negative max means unlimited seeds are allowed, so don't do anything
         if max_seeds < 0:
@@ -357,53 +881,57 @@ class Core(CorePluginBase):
         if len(torrent_ids) <= max_seeds:
             return
 
+        # one lookup of every label, shared by the exemption scan,
+        # the specific rules and the unfinished torrent branch
+        labels = self.get_labels(torrent_ids) if labels_enabled else None
+        if labels is None:
+            labels_enabled = False
+            labels = {}
+
         torrents = []
         ignored_torrents = []
+        now = time.time()
 
-        # relevant torrents to us exist and are finished
-        for i in torrent_ids:
-            t = torrentmanager.torrents.get(i, None)
-      
-            try:
-                ignored = self.torrent_states[i]
-            except KeyError as e:
-                ignored = False
+        # torrents changed by an event since the last cycle are evaluated
+        # again, and every so often all of them are as a safety net
+        dirty, self.dirty = self.dirty, set()
+        full_scan = now - self.last_full_scan >= self.config['full_scan_interval'] * 3600.0
+        if full_scan or labels_enabled != self.labels_enabled:
+            log.info("AutoRemovePlus: full evaluation of all torrents")
+            self.eval_states = {}
+            self.deadlines = []
+            self.last_full_scan = now
+        self.labels_enabled = labels_enabled
 
-            ex_torrent = False
-            trackers = t.trackers
+        engine = self.config['eval_engine']
+        if engine == 'numpy' and not columnar.available():
+            log.warning("AutoRemovePlus: numpy is not installed, evaluating without it")
+            engine = 'python'
+        in_processes = engine == 'python' and self.config['eval_processes'] > 0 and spec.enabled
 
-            # check if trackers in exempted tracker list
-            for tracker, ex_tracker in (
-                (t, ex_t) for t in trackers for ex_t in exemp_trackers
-            ):
-                if(tracker['url'].find(ex_tracker.lower()) != -1):
-                    log.debug("Found exempted tracker: %s" % (ex_tracker))
-                    ex_torrent = True
+        # decisions made here read the expensive keys only specific rules
+        # need when they get to them, numpy and worker processes up front
+        keys = policy.keys
+        if engine == 'python' and not in_processes:
+            keys = [key for key in policy.keys if key not in policy.lazy_keys]
 
-            # check if labels in exempted label list if Label plugin is enabled
-            if labels_enabled:
-                try:
-                    # get label string
-                    label_str = component.get(
-                        "CorePlugin.Label"
-                    )._status_get_label(i)
-
-                    # if torrent has labels check them
-                    labels = [label_str] if len(label_str) > 0 else []
-
-                    for label, ex_label in (
-                        (l, ex_l) for l in labels for ex_l in exemp_labels
-                    ):
-                        if(label.find(ex_label.lower()) != -1):
-                            log.debug("Found exempted label: %s" % (ex_label))
-                            ex_torrent = True
-                except Exception as e:
-                    log.warning("Cannot obtain torrent label: {}".format(e))
-
-            # if torrent tracker or label in exemption list, or torrent ignored
-            # insert in the ignored torrents list
-            (ignored_torrents if ignored or ex_torrent else torrents)\
-                .append((i, t))
+        # the library is scanned a slice at a time, so deluged keeps
+        # answering while a large library is checked
+        cycle = CycleState(
+            torrentmanager=torrentmanager,
+            torrent_ids=torrent_ids,
+            labels=labels,
+            labels_enabled=labels_enabled,
+            dirty=dirty,
+            policy=policy,
+            keys=keys,
+            now=now,
+            torrents=torrents,
+            ignored_torrents=ignored_torrents,
+            classified=0
+        )
+        yield self.cooperator.cooperate(self.scan_torrents(cycle)).whenDone()
+        classified = cycle.classified
 
         log.info("Number of ignored torrents: {0}".format(len(ignored_torrents)))
 
@@ -420,183 +948,83 @@ class Core(CorePluginBase):
             if max_seeds < 0:
                 max_seeds = 0
  
-        # Alternate sort by primary and secondary criteria
-        torrents.sort(
-            key=lambda x: (
-                filter_funcs.get(
-                    self.config['filter'],
-                    _get_ratio
-                )(x),
-                filter_funcs.get(
-                    self.config['filter2'],
-                    _get_ratio
-                )(x)
-            ),
-            reverse=False
+        metric_cache = MetricCache(
+            lambda torrent_id, keys: torrentmanager.torrents[torrent_id].get_status(keys)
         )
 
-        changed = False
+        # Alternate sort by primary and secondary criteria, only the
+        # torrents beyond max_seeds are pulled out, highest first
+        if engine == 'numpy':
+            columns = columnar.Columns(torrents, now)
+            order = columns.select(spec.filter, spec.filter2, max_seeds)
+            candidates = [torrents[k] for k in order]
+        else:
+            candidates = select_candidates(
+                torrents,
+                lambda x: (
+                    metric_cache.get(x, spec.filter),
+                    metric_cache.get(x, spec.filter2)
+                ),
+                max_seeds
+            )
 
-        # remove or pause these torrents
-        for i, t in reversed(torrents[max_seeds:]):
-            name = t.get_status(['name'])['name']
-            log.debug("Now processing name = {}, type = {}".format(name,type(name)))
-            # check if free disk space below minimum
-            if self.check_min_space():
-                break  # break the loop, we have enough space
-                
-            if enabled:
-                # Get result of first condition test
-                filter_1 = filter_funcs.get(self.config['filter'], _get_ratio)((i, t)) <= min_val
-                # Get result of second condition test
-                
-                #chosen_func = self.config['filter2']
-                # prevent hit and runs
-                max_val2 = max_val2 if max_val2 > 0.5 else 0.5
-                #log.info("Chosen filter2 : {}, cut-off: {}".format(chosen_func,max_val2))
-                
-                filter_2 = filter_funcs.get(self.config['filter2'], _get_ratio)((i, t)) >= max_val2
-
-                specific_rules = self.get_torrent_rules(i, t, tracker_rules, label_rules)
-
-                # Sort rules according to logical operators, AND is evaluated first
-                specific_rules.sort(key=lambda rule: rule[0])
-
-                remove_cond = False
-                seed_remove_cond  = False #for removing finished torrents
-
-                # If there are specific rules, ignore general remove rules
-                if specific_rules:
-                    remove_cond = filter_funcs.get(specific_rules[0][1])((i,t)) \
-                        >= specific_rules[0][2]
-                    for rule in specific_rules[1:]:
-                        check_filter = filter_funcs.get(rule[1])((i,t)) \
-                            >= rule[2]
-                        remove_cond = sel_funcs.get(rule[0])((
-                            check_filter,
-                            remove_cond
-                        ))
-                    seed_remove_cond = remove_cond
-                elif rule_1_chk and rule_2_chk:
-                    # If both rules active use custom logical function
-                    remove_cond = sel_funcs.get(self.config['sel_func'])((
-                        filter_1,
-                        filter_2
-                    ))
-                elif rule_1_chk and not rule_2_chk:
-                    # Evaluate only first rule, since the other is not active
-                    remove_cond = filter_1
-                elif not rule_1_chk and rule_2_chk:
-                    # Evaluate only second rule, since the other is not active
-                    remove_cond = filter_2
-
-                # If logical functions are satisfied remove or pause torrent
-                # add check that torrent is not completed
-                try:
-                    name = t.get_status(['name'])['name']
-                    age = _age_in_days((i,t)) # age in days
-                    seedtime = t.get_status(['seeding_time'])['seeding_time']/3600 #seed time in hours
-                    ratio = t.get_status(['ratio'])['ratio']
-                    availability = t.get_status(['distributed_copies'])['distributed_copies']
-                    isFinished = t.get_status(['is_finished'])['is_finished']
-                    paused = t.get_status(['paused'])['paused']
-                    hash = t.get_status(['hash'])['hash'].upper()                    
-                except Exception as e:
-                    log.error("Error with torrent: {}".format(e))
-                    continue
-                    
-                if not isFinished:
-                    try:
-                        label_str = component.get("CorePlugin.Label")._status_get_label(i)
-                        if not label_str:
-                            log.warning("Torrent: {}, label = {}".format(name,label_str))
-                    except Exception as e:
-                        log.error("Error getting label for torrent {}: {}".format(name,e))
-                    log.debug("Processing unfinished torrent {}, label = {}".format(name,label_str))
-                    if remove_cond:
-                        #user has selected to remove torrents
-                        if remove:
-                            # communicate with media servers and remove from their api
-                            if label_str == 'tv-sonarr':
-                                if use_sonarr: # remove using sonarr api and blacklist
-                                    if len(sonarr_list) > 0:
-                                        if hash in sonarr_list:
-                                            id = str(sonarr_list[hash].get('id'))
-                                            log.info("hash: {}, id: {},type = {}".format(hash,id,type(id)))
-                                            response = self.sonarr.delete_queueitem(id)
-                                            changed = True
-                                            log.info("Sending removal request for {}/{} for torrent {}: => {}".format(id,hash,name,response))
-                                            continue
-                                        else:
-                                            log.warning("Could not find torrent {} in sonarr queue:{}".format(name,hash))
-                                            log.info("List: {}".format(sonarr_list))
-                                else: # remove using local method
-                                    result = self.remove_torrent(torrentmanager, i, remove_data)
-                                    log.info("AutoRemovePlus: removing unfinished torrent {} with data using internal method: {}".format(name,result))
-                            elif label_str == 'lidarr':
-                                if use_lidarr: # remove using lidarr api and blacklist
-                                    if len(lidarr_list) > 0:
-                                        if hash in lidarr_list:
-                                            id = str(lidarr_list[hash].get('id'))
-                                            log.info("hash: {}, id: {},type = {}".format(hash,id,type(id)))
-                                            response = self.lidarr.delete_queueitem(id)
-                                            changed = True
-                                            log.info("Sending removal request for {}/{} for torrent {}: => {}".format(id,hash,name,response))
-                                            continue
-                                        else:
-                                            log.warning("Could not find torrent {} in lidarr queue:{}".format(name,hash))
-                                            log.info("List: {}".format(lidarr_list))
-                                else: # remove using local method
-                                    result = self.remove_torrent(torrentmanager, i, remove_data)
-                                    log.info("AutoRemovePlus: removing unfinished torrent {} with data using internal method: {}".format(name,result))                                
-                            elif label_str == 'radarr': 
-                                if use_radarr:
-                                    if len(radarr_list) > 0:
-                                        if hash in radarr_list:
-                                            id = str(radarr_list[hash].get('id'))
-                                            log.info("hash: {}, id: {},type = {}".format(hash,id,type(id)))
-                                            response = self.radarr.delete_queueitem(id)
-                                            changed = True
-                                            log.info("Sending removal request for {}/{} for torrent {}: => {}".format(id,hash,name,response))
-                                            continue
-                                        else:
-                                            log.warning("Could not find torrent {} in radarr queue:{}".format(name,hash))
-                                            log.info("List: {}".format(radarr_list))
-                                else: # remove using local method
-                                    result = self.remove_torrent(torrentmanager, i, remove_data)
-                                    log.info("AutoRemovePlus: removing unfinished torrent {} with data using internal method: {}".format(name,result))
-                            else:
-                                log.debug("No matching label {}for torrent {}, or queue not returned from server. Hash = {}".format(label_str,name,hash))
-                        else:
-                            #pause instead
-                            if not paused:
-                                log.info("AutoRemovePlus: Pausing torrent {} due to availability = {} and age = {}".format(name, availability, age))
-                                self.pause_torrent(t)                        
-
-                else: # is finished
-                    
-                  log.debug("Fin.: {}, seed time:{}/{}, ratio: {}, spec. rules = {}, sr cond. = {}/{},isfinished = {}, hash = {}".format(name,seedtime,seedtime_limit,ratio,specific_rules,remove_cond,seed_remove_cond,isFinished,hash))                  
-                  if (not specific_rules) or (seed_remove_cond):                                       
-                    #remove condition
-                    if seedtime > seedtime_limit:
-                        if not always_pause_seed:
-                            #Sending False to remove data because it is probably not intended for completed torrents
-                            self.remove_torrent(torrentmanager, i, False)
-                            changed = True
-                            log.info("AutoRemovePlus: removing torrent from seed: {} due to seed time = {}/{} h".format(name,seedtime,seedtime_limit))
-                        
-                    #pause condition
-                    elif seedtime > seedtime_pause: 
-                      try:
-                        #paused = t.get_status(['paused'])['paused']
-                        if not paused:
-                          self.pause_torrent(t)
-                          #changed = True
-                          log.info("AutoRemovePlus: pausing finished torrent {} with seedtime = {}/{} h, ratio = {}, rules = {}, sr-cond = {}/{}".format(name,seedtime,seedtime_pause,ratio,specific_rules,remove_cond,seed_remove_cond))
-                        else:
-                          log.debug("AutoRemovePlus: torrent is already paused: {}".format(name))
-                      except Exception as e:
-                          log.warning("AutoRemovePlus: error with pausing torrent: {}".format(name))
+        # torrents to remove through each media server, sent after the scan
+        removals = {}
+        cycle.spec = spec
+        cycle.metric_cache = metric_cache
+        cycle.remove_data = remove_data
+        cycle.removals = removals
+        cycle.decisions = {}
+        cycle.errors = {}
+        cycle.changed = False
+        cycle.skipped = 0
+
+        # large libraries can be decided on all at once with numpy, or in
+        # other processes, whatever they could not decide on is decided here
+        if engine == 'numpy':
+            rule_sets = []
+            for s in torrents:
+                state = self.eval_states.get(s.id)
+                rule_sets.append(state.ruleset if state is not None else NO_RULES)
+            # candidates skipped by the action loop need no decision
+            due = [k for k in order if now >= getattr(self.eval_states.get(torrents[k].id), 'next_check', now)]
+            cycle.decisions, cycle.errors = columns.decide(rule_sets, spec, due)
+        elif in_processes:
+            try:
+                yield self.evaluate_in_processes(cycle, candidates)
+                engine = 'processes'
+            except Exception as e:
+                log.warning("AutoRemovePlus: evaluation in worker processes failed, evaluating here: {}".format(e))
+                # a broken pool fails every later submit, start a new one next cycle
+                if self.process_pool is not None:
+                    self.process_pool.shutdown(wait=False)
+                    self.process_pool = None
+                cycle.decisions = {}
+                cycle.errors = {}
+
+        yield self.cooperator.cooperate(self.act_on_candidates(cycle, candidates)).whenDone()
+        changed = cycle.changed
+        skipped = cycle.skipped
+
+        if removals:
+            changed = (yield self.remove_from_servers(removals)) or changed
+            self.save_queues()
+
+        self.cycle_stats = {
+            'torrents': len(torrent_ids),
+            'ignored': len(ignored_torrents),
+            'classified': classified,
+            'skipped': skipped,
+            'full_scan': full_scan,
+            'engine': engine,
+            'metric_cache': metric_cache.stats(),
+            'rulesets': policy.rulebook.stats()
+        }
+        log.info("AutoRemovePlus: classified {} torrents, skipped {} unchanged candidates".format(classified, skipped))
+
+        self.last_cycle = now
+        self.schedule_deadline()
+        log.info("AutoRemovePlus: metric cache hits = {hits}, misses = {misses}, expensive lookups = {expensive}, avoided = {avoided}".format(**metric_cache.stats()))
 
         # If a torrent exemption state has been removed save changes
         if changed:
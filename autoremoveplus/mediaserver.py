@@ -23,16 +23,23 @@ from builtins import object
 import argparse
 import requests
 import json
+import codecs
+import fnmatch
 import io
 import os
+import time
+import threading
 import logging
 import configparser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 log = logging.getLogger(__name__)
 
 from deluge.plugins.pluginbase import CorePluginBase
 import deluge.component as component
 import deluge.configmanager
 from deluge.core.rpcserver import export
+from twisted.internet import reactor, threads, defer
+from twisted.python.threadpool import ThreadPool
 
 
 httpErrors = {
@@ -100,107 +107,442 @@ httpErrors = {
     #@TODO Add full list
 }
 
+# Bytes read at a time when streaming a queue response
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Seconds a queue loaded from disk is served whatever its age, so the first
+# cycle after a restart doesn't wait for the sync started with it
+WARM_START_GRACE = 300.0
+
+def iter_json_array(chunks):
+    """ Yields the elements of a JSON array read from an iterable of byte chunks
+
+        Each element is decoded as soon as it is complete, the buffer only
+        ever holds the element being read and the rest of the current chunk.
+        Elements are expected to be objects or arrays, like queue records.
+    """
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    started = False
+    done = False
+    chunks = iter(chunks)
+    while True:
+        # skip whitespace, the opening bracket and separators
+        while pos < len(buf) and (buf[pos] in ' \t\r\n,' or (not started and buf[pos] == '[')):
+            if buf[pos] == '[':
+                started = True
+            pos += 1
+        if pos < len(buf):
+            if not started:
+                raise ValueError("Expected a JSON array, got {!r}".format(buf[pos:pos + 20]))
+            if buf[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # element not complete yet, unless the stream has ended
+                if done:
+                    raise
+            else:
+                yield element
+                pos = end
+                continue
+        if done:
+            raise ValueError("Unexpected end of JSON array")
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            done = True
+            chunk = b''
+        buf = buf[pos:] + decode.decode(chunk, final=done)
+        pos = 0
+
+
 class HTTP_MethodError(Exception):
     def __init__(self, value):
         self.value = value
     def __str__(self):
         return repr(self.value)
 
+class CircuitOpenError(HTTP_MethodError):
+    pass
+
+class CircuitBreaker(object):
+    """ Stops calls to a server that keeps failing
+
+        After threshold failures in a row the circuit opens and calls fail at once.
+        Once the backoff has passed one probe call is let through (half-open): if
+        it succeeds the circuit closes, if not it opens again for twice as long.
+    """
+    def __init__(self, threshold=2, backoff=60.0, max_backoff=3600.0):
+        self.threshold   = threshold
+        self.min_backoff = backoff
+        self.max_backoff = max_backoff
+        self.backoff     = backoff
+        self.state       = 'closed'
+        self.failures    = 0
+        self.trips       = 0
+        self.opened_at   = 0.0
+        self.probing     = False
+
+    def blocked(self):
+        """ True if a call now would be refused, without using up the probe
+        """
+        if self.state == 'open':
+            return time.time() - self.opened_at < self.backoff
+        return self.state == 'half-open' and self.probing
+
+    def allow(self):
+        if self.state == 'open' and time.time() - self.opened_at >= self.backoff:
+            self.state = 'half-open'
+        if self.state == 'half-open' and not self.probing:
+            self.probing = True
+            return True
+        return self.state == 'closed'
+
+    def success(self):
+        self.state    = 'closed'
+        self.failures = 0
+        self.probing  = False
+        self.backoff  = self.min_backoff
+
+    def failure(self):
+        self.failures += 1
+        if self.state == 'half-open':
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+        elif self.failures < self.threshold:
+            return
+        self.state     = 'open'
+        self.opened_at = time.time()
+        self.probing   = False
+        self.trips    += 1
+        log.warning("Circuit opened after {} failures, next try in {:.0f} s".format(self.failures,self.backoff))
+
+    def status(self):
+        return {
+            'state'   : self.state,
+            'failures': self.failures,
+            'trips'   : self.trips,
+            'backoff' : self.backoff,
+            'retry_in': max(self.opened_at + self.backoff - time.time(), 0.0) if self.state == 'open' else 0.0
+        }
+
+# API version each server type speaks when the config names none. Servers
+# with a versioned api page their queue and can delete in bulk, the legacy
+# radarr api returns the whole queue at once.
+DEFAULT_API_VERSIONS = {
+    'sonarr': 3,
+    'lidarr': 1,
+    'radarr': None
+}
+
 class Mediaserver(object):
-    def __init__(self, server, apikey, type='sonarr'):
+    def __init__(self, server, apikey, type='sonarr', page_size=250, fanout=4, lookup_limit=5, api_version=None, endpoint=None, name=None):
+        if type not in DEFAULT_API_VERSIONS:
+            raise Exception('Unknown server: {}'.format(type))
+        if api_version is None:
+            api_version = DEFAULT_API_VERSIONS[type]
         self.server     = server
         self.api_key    = apikey
         self.type       = type
-        self.endpoint       = '/sonarr/api/v3' if type == 'sonarr' else '/lidarr/api/v1' if type == 'lidarr' else '/radarr/api' if type == 'radarr' else None
+        self.name       = name or type
+        self.api_version = api_version
+        self.page_size  = page_size
+        self.fanout     = fanout
+        self.lookup_limit = lookup_limit
+        self.failed_pages = []
+        self.queue      = None
+        self.queue_time = 0.0
+        # the cached queue is replaced by syncs and deletes on pool threads
+        # and by webhook events on the reactor, one at a time
+        self.queue_lock = threading.Lock()
+        # bumped on every change, so changes from events get saved too
+        self.queue_version = 0
+        self.warm_until = 0.0
+        self.total_records = None
+        # cost of the requests sent, read by lookup() to log what it spent
+        self.cost_lock  = threading.Lock()
+        self.requests_sent  = 0
+        self.bytes_received = 0
+        if endpoint is None:
+            endpoint = '/{}/api'.format(type) + ('/v{}'.format(api_version) if api_version else '')
+        self.endpoint       = endpoint
+        self.paged          = bool(api_version)
+        # versioned apis can delete many queue items in one request
+        self.bulk_delete    = self.paged
               
-        if self.endpoint is None:
-            raise Exception('Unknown server: {}'.format(type))
-        
-        log.info ("Endpoint of {} is {}".format(self.type,self.endpoint))
-
-    def get_queue(self):
-        """ Get queue from server
-        """
+        log.info ("Endpoint of {} ({}) is {}".format(self.name,self.type,self.endpoint))
 
-        # Create and send HTTP Get to the mediaserver
-        h={
+        # One keep-alive session per server, shared by every request
+        self.session = requests.Session()
+        self.session.headers.update({
             'http.useragent' : 'Deluge-autoremoveplus',
             'x-api-key'      :  self.api_key,
             'Content-Type'   : 'application/json',
             'User-Agent'     : 'Deluge/Autoremoveplus',
             'Accept-Encoding': 'gzip'
-        }
+        })
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(8, fanout))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_queue_page(self, pagenum, descending=False):
+        """ Get one page of the queue from server, decoded
+
+            With descending, pages are sorted on time left longest first,
+            which puts stalled downloads on the first pages.
+        """
+        try:
+            url = self.server + self.endpoint + '/queue?page={}&pageSize={}'.format(pagenum, self.page_size)
+            if descending:
+                url += '&sortKey=timeleft&sortDirection=descending'
+            log.info("Sending GET request to {}".format(url))
+            r = self.session.get(url, timeout=30)
+        except Exception as e:
+            raise HTTP_MethodError('Error Connecting to server: {}'.format(e))
         
-        pagenum = 1
-        output = {}
+        log.debug("HTTP {}: {}".format(r.status_code,httpErrors[r.status_code]))
+        with self.cost_lock:
+            self.requests_sent += 1
+            self.bytes_received += len(r.content)
         
-        while True:
+        if r.status_code == 200: #200 = 'OK'
+            return r.json()
+        else:
+            raise Exception("Cannot get queue:  {} ({})".format(r.status_code,httpErrors[r.status_code]))
+
+    def stream_queue(self):
+        """ Get the whole queue of a server without paging (radarr)
+
+            The response is decoded one record at a time, so only the fields
+            add_records keeps are held in memory, never the full decoded list.
+        """
+        try:
+            url = self.server + self.endpoint + '/queue'
+            log.info("Sending GET request to {}".format(url))
+            r = self.session.get(url, timeout=30, stream=True)
+        except Exception as e:
+            raise HTTP_MethodError('Error Connecting to server: {}'.format(e))
+
+        log.debug("HTTP {}: {}".format(r.status_code,httpErrors[r.status_code]))
+        if r.status_code != 200: #200 = 'OK'
+            r.close()
+            with self.cost_lock:
+                self.requests_sent += 1
+            raise Exception("Cannot get queue:  {} ({})".format(r.status_code,httpErrors[r.status_code]))
+
+        received = [0]
+        def chunks():
+            for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                received[0] += len(chunk)
+                yield chunk
+
+        output = {}
+        try:
+            self.add_records(output, iter_json_array(chunks()))
+        finally:
+            r.close()
+            with self.cost_lock:
+                self.requests_sent += 1
+                self.bytes_received += received[0]
+        return output
+
+    def add_records(self, output, records):
+        # errors reading or decoding records propagate, so a truncated
+        # queue is never taken for the whole one, only bad records are skipped
+        for data in records:
             try:
-                url = self.server + self.endpoint + '/queue?' +str('page=') + str(pagenum)
-                log.info("Sending GET request to {}".format(url))
-                r = requests.get(url, headers=h,timeout=30)
+                output[data.get('downloadId')] = {'id':data.get('id'),'title':data.get('title')}
             except Exception as e:
-                raise HTTP_MethodError('Error Connecting to server: {}'.format(e))
-            
-            log.debug("HTTP {}: {}".format(r.status_code,httpErrors[r.status_code]))
-            
-            if r.status_code == 200: #200 = 'OK'
-                total_records = r.json()['totalRecords'] if  (self.type == 'lidarr' or self.type == 'sonarr') else -1 # return negative number if no total is available
-                records_left = total_records-pagenum*10
-                log.debug("Page {}, total records {}, left {}".format(pagenum,total_records,records_left))
-                parsedata = (r.json()['records'] if (self.type == 'lidarr' or self.type == 'sonarr') else r.json())
-                #log.info("Parsedata = {}, size = {}, type = {}, response = {}".format(parsedata,len(parsedata),self.type,r.json()))
+                log.error("Invalid mediaserver type: {}, {}".format(self.name,e))
+
+    def cached_queue(self, max_age, warm=False):
+        """ Return the last queue if it is younger than max_age seconds, else None
+
+            With warm, a queue loaded from disk less than WARM_START_GRACE
+            seconds ago is returned whatever its age. Only lookups use it, the
+            syncs that replace it must not.
+        """
+        with self.queue_lock:
+            queue, queue_time, warm_until = self.queue, self.queue_time, self.warm_until
+        if queue is None:
+            return None
+        now = time.time()
+        if now - queue_time < max_age or (warm and now < warm_until):
+            return queue
+        return None
+
+    def get_queue(self):
+        """ Get queue from server
+
+            Page 1 tells the size of the queue, the other pages are then fetched
+            with up to fanout requests in flight. A page that fails twice is
+            skipped and listed in failed_pages, the rest of the queue is returned
+            but only a complete queue replaces the cached one.
+        """
+        if not self.paged:
+            # the legacy radarr api returns the whole queue at once
+            output = self.stream_queue()
+            self.failed_pages = []
+            self.total_records = len(output)
+            with self.queue_lock:
+                self.queue, self.queue_time = output, time.time()
+                self.queue_version += 1
+                self.warm_until = 0.0
+            log.info("Returning {} records from {} queue".format(len(output),self.name))
+            return output
+        
+        output = {}
+        response = self.get_queue_page(1)
+        total_records = response['totalRecords']
+        # the server may cap the page size we asked for
+        page_size = response.get('pageSize') or self.page_size
+        pages = -(-total_records // page_size)
+        self.add_records(output, response['records'])
+        log.debug("Total records {}, page size {}, pages {}".format(total_records,page_size,pages))
+        
+        if pages > 500:
+            log.warn("Capped at 500 pages for server {}. Total records reported as {}".format(self.name,total_records))
+            pages = 500
+        
+        failed = []
+        if pages > 1:
+            with ThreadPoolExecutor(max_workers=self.fanout) as executor:
+                futures = dict((executor.submit(self.get_queue_page, n), n) for n in range(2, pages + 1))
+                for future in as_completed(futures):
+                    try:
+                        self.add_records(output, future.result()['records'])
+                    except Exception as e:
+                        log.warning("Page {} of {} queue failed: {}".format(futures[future],self.name,e))
+                        failed.append(futures[future])
+            # one more try for failed pages, one at a time
+            for pagenum in sorted(failed):
                 try:
-                    for data in parsedata:
-                        #log.info("Parsing {} data: {}".format(self.type,data))
-                        output[data.get('downloadId')] = {'id':data.get('id'),'title':data.get('title')}       
+                    self.add_records(output, self.get_queue_page(pagenum)['records'])
+                    failed.remove(pagenum)
                 except Exception as e:
-                    log.error("Invalid mediaserver type: {}, {}".format(self.type,e))
-                if records_left <= 0: break;
-                pagenum += 1
-                
-                if pagenum > 500:
-                    log.warn("Capped at 500 iterations for server {}. Total records reported as {}".format(self.type,total_records))
-                    break;
-                
-            else:
-                raise Exception("Cannot get queue:  {} ({})".format(r.status_code,httpErrors[r.status_code]))
-                
-        log.info("Returning {} records from {} queue".format(len(output),self.type))
+                    log.error("Skipping page {} of {} queue: {}".format(pagenum,self.name,e))
+        self.failed_pages = failed
+        self.total_records = total_records
+        if failed:
+            # a partial queue is returned but not cached, the previous queue
+            # keeps its sync time and is not saved again
+            log.warning("Not caching {} queue, {} pages failed".format(self.name,len(failed)))
+        else:
+            with self.queue_lock:
+                self.queue, self.queue_time = output, time.time()
+                self.queue_version += 1
+                self.warm_until = 0.0
+        
+        log.info("Returning {} records from {} queue in {} pages, {} failed".format(len(output),self.name,pages,len(failed)))
         return output
                
+    def search_queue(self, hashes):
+        """ Look for download ids where stalled downloads are in the queue
+
+            The queue endpoints cannot filter on a download id. Pages sorted on
+            time left, longest first, are read fanout at a time until every id
+            is found, so the stalled downloads removal candidates usually are
+            cost one wave of requests. The records read are merged into the
+            cached queue, and once every page was read they replace it.
+        """
+        wanted = set(hashes)
+        scanned = {}
+        response = self.get_queue_page(1, descending=True)
+        self.add_records(scanned, response['records'])
+        total_records = response['totalRecords']
+        page_size = response.get('pageSize') or self.page_size
+        pages = min(-(-total_records // page_size), 500)
+        pagenum = 2
+        while not wanted.issubset(scanned) and pagenum <= pages:
+            wave = list(range(pagenum, min(pagenum + self.fanout, pages + 1)))
+            with ThreadPoolExecutor(max_workers=self.fanout) as executor:
+                for response in executor.map(lambda n: self.get_queue_page(n, True), wave):
+                    self.add_records(scanned, response['records'])
+            pagenum += len(wave)
+        self.total_records = total_records
+
+        if pagenum > pages:
+            # every page was read, as good as a full sync
+            with self.queue_lock:
+                self.queue, self.queue_time = scanned, time.time()
+                self.queue_version += 1
+                self.warm_until = 0.0
+            self.failed_pages = []
+        else:
+            self.merge_queue(scanned)
+        return dict((hash, scanned[hash]) for hash in hashes if hash in scanned)
+
+    def lookup_strategy(self, count):
+        """ Pick how to find count download ids: 'targeted' or 'full'
+
+            A full sync reads every page, fanout at a time. A targeted search
+            usually finds stalled downloads in its first wave, so it pays off
+            for a few ids in a queue of more than one wave of pages, whose size
+            is known from an earlier sync.
+        """
+        if not self.paged:
+            return 'full' # the whole queue comes in one request anyway
+        if self.total_records is None or count > self.lookup_limit:
+            return 'full'
+        if -(-self.total_records // self.page_size) <= self.fanout:
+            return 'full'
+        return 'targeted'
+
+    def lookup(self, hashes, max_age=0):
+        """ Get the queue items of the given download ids
+
+            Ids found in a cached queue younger than max_age seconds cost nothing,
+            the rest are looked up with the strategy from lookup_strategy().
+        """
+        found = {}
+        queue = self.cached_queue(max_age, warm=True)
+        if queue is not None:
+            # grabs announced by webhook have no queue id yet
+            found = dict((hash, queue[hash]) for hash in hashes if queue.get(hash, {}).get('id') is not None)
+        missing = [hash for hash in hashes if hash not in found]
+        if not missing:
+            log.info("Found {} ids in cached {} queue".format(len(found),self.name))
+            return found
+        
+        strategy = self.lookup_strategy(len(missing))
+        requests_sent, bytes_received, start = self.requests_sent, self.bytes_received, time.time()
+        result = self.search_queue(missing) if strategy == 'targeted' else self.get_queue()
+        for hash in missing:
+            if hash in result:
+                found[hash] = result[hash]
+        log.info("{} lookup of {} ids in {} queue of {} records: found {}, {} requests, {} bytes, {:.2f} s".format(
+            strategy,len(missing),self.name,self.total_records,len(found),
+            self.requests_sent-requests_sent,self.bytes_received-bytes_received,time.time()-start))
+        return found
+
     def get_blacklist(self):
         """ Get blacklist from server
             
         """
         
-        # Create and send HTTP Get to the mediaserver
-        h={
-            'http.useragent' : 'Deluge-autoremoveplus',
-            'x-api-key'      :  self.api_key,
-            'Content-Type'   : 'application/json',
-            'User-Agent'     : 'Deluge/Autoremoveplus',
-            'Accept-Encoding': 'gzip'
-        }
 
         url = self.server + self.endpoint + '/blacklist?sortkey=date'
 
         log.info("Sending GET request to {}: type = {}".format(url,type(url)))
         
         try:
-            r = requests.get(url, headers=h,timeout=30)
+            r = self.session.get(url, timeout=30)
         except Exception as e:
             raise HTTP_MethodError('Error Connecting to server: {}'.format(e))
         
         log.debug ("HTTP {}: {}".format(r.status_code,httpErrors[r.status_code]))
         
         if r.status_code == 200: #200 = 'OK'
-            output = r.json().get('records') if r.json().get('records') else r.json()
+            response = r.json()
+            output = response.get('records') if response.get('records') else response
             return output
         else:
             #return r.status_code,r.json()
             #log.info ("HTTP {}: {}".format(r.status_code,httpErrors[r.status_code]))
-            log.error("Error getting blacklist for {}: {}".format(self.type,r.status_code))
+            log.error("Error getting blacklist for {}: {}".format(self.name,r.status_code))
             return False
         
     def delete_blacklist_item(self, item_id):
@@ -208,20 +550,12 @@ class Mediaserver(object):
             
         """
         
-        # Create and send HTTP Delete to the mediaserver
-        h={ #For some reason header update doesnt work
-            'http.useragent' : 'Deluge-autoremoveplus',
-            'x-api-key'      :  self.api_key,
-            'Content-Type'   : 'application/json',
-            'User-Agent'     : 'Deluge/Autoremoveplus',
-            'Accept-Encoding': 'gzip'
-        }
         query = str(item_id)
         url = self.server + self.endpoint + '/blacklist/'+ query
         log.info("Sending DELETE request to {}: type = {}".format(url,type(url)))
         
         try:
-            r = requests.delete(url, headers=h,timeout=30)
+            r = self.session.delete(url, timeout=30)
         except Exception as e:
             raise HTTP_MethodError('Error Connecting to server: {}'.format(e))
         
@@ -231,21 +565,13 @@ class Mediaserver(object):
         else:
             #return r.status_code,r.json()
             log.error ("HTTP {}: {}".format(r.status_code,httpErrors[r.status_code]))
-            raise Exception("Error deleting blacklist item for {}: {}".format(self.type,r.status_code))
+            raise Exception("Error deleting blacklist item for {}: {}".format(self.name,r.status_code))
 
     def delete_queueitem(self,item_id,blacklist = 'true'):
         """ Get queue from server
             
         """
         
-        # Create and send HTTP Delete request to the mediaserver
-        h={
-            'http.useragent' : 'Deluge-autoremoveplus',
-            'x-api-key'      :  self.api_key,
-            'Content-Type'   : 'application/json',
-            'User-Agent'     : 'Deluge/Autoremoveplus',
-            'Accept-Encoding': 'gzip'
-        }
         log.info("Parsing item id: {}, type = {}".format(item_id,type(item_id)))
         try:
             query = str(item_id)+'?blacklist='+str(blacklist)
@@ -257,13 +583,15 @@ class Mediaserver(object):
         log.info("Sending DELETE request to {}: type = {}".format(url,type(url)))
         
         try:
-            r = requests.delete(url, headers=h,timeout=30)
+            r = self.session.delete(url, timeout=30)
         except Exception as e:
             raise HTTP_MethodError('Error Connecting to server: {}'.format(e))
         
         log.info ("HTTP {}: {}".format(r.status_code,httpErrors[r.status_code]))
         
         if r.status_code == 200: #200 = 'OK'
+            # the item has left the queue, so drop it from the cached copy
+            self.drop_from_queue([item_id])
             try:
                 output = r.json()
             except Exception as e:
@@ -276,6 +604,252 @@ class Mediaserver(object):
             return False
  
 
+    def export_queue(self):
+        """ Return the cached queue in the compact form kept on disk, or None
+        """
+        with self.queue_lock:
+            queue, queue_time = self.queue, self.queue_time
+        if queue is None:
+            return None
+        return {
+            'synced': queue_time,
+            'queue': dict((k, [v.get('id'), v.get('title')]) for (k, v) in queue.items())
+        }
+
+    def import_queue(self, data):
+        """ Load a queue saved by export_queue()
+
+            It keeps the time it was synced at, and is served whatever its age
+            for WARM_START_GRACE seconds while the first sync runs.
+        """
+        queue = dict((k, {'id':v[0],'title':v[1]}) for (k, v) in data['queue'].items())
+        with self.queue_lock:
+            self.queue = queue
+            self.queue_version += 1
+            self.queue_time = data['synced']
+            self.warm_until = time.time() + WARM_START_GRACE
+        log.info("Loaded {} records of {} queue synced at {}".format(len(queue),self.name,time.ctime(data['synced'])))
+
+    def apply_event(self, event):
+        """ Update the cached queue from a webhook event of the server
+
+            A grab adds the download without a queue id, which the next lookup
+            resolves. An import or a delete takes it out of the queue. Returns
+            True if the cached queue changed.
+        """
+        event_type = event.get('eventType') or ''
+        download_id = event.get('downloadId')
+        if not download_id:
+            return False
+        download_id = download_id.upper()
+        with self.queue_lock:
+            if self.queue is None:
+                return False
+            queue = dict(self.queue)
+            if event_type == 'Grab':
+                title = (event.get('release') or {}).get('releaseTitle')
+                queue.setdefault(download_id, {'id':None,'title':title})
+            elif event_type == 'Download' or 'Delete' in event_type:
+                queue.pop(download_id, None)
+            else:
+                return False
+            self.queue = queue
+            self.queue_version += 1
+        log.debug("{} event for {} on {}, {} items in queue".format(event_type,download_id,self.name,len(queue)))
+        return True
+
+    def merge_queue(self, records):
+        """ Add records read outside a full sync to the cached queue
+        """
+        with self.queue_lock:
+            if self.queue is not None:
+                queue = dict(self.queue)
+                queue.update(records)
+                self.queue = queue
+                self.queue_version += 1
+
+    def drop_from_queue(self, item_ids):
+        """ Drop deleted items from the cached queue
+        """
+        item_ids = set(str(item_id) for item_id in item_ids)
+        with self.queue_lock:
+            if self.queue is not None:
+                self.queue = dict((k, v) for (k, v) in self.queue.items() if str(v.get('id')) not in item_ids)
+                self.queue_version += 1
+
+    def delete_queueitems(self, item_ids, blacklist = 'true'):
+        """ Delete several queue items, returns a map of item id to True/False
+
+            Uses the bulk endpoint of the server where there is one, else sends
+            single deletes with up to fanout requests in flight.
+        """
+        if self.bulk_delete and len(item_ids) > 1:
+            url = self.server + self.endpoint + '/queue/bulk?blacklist=' + str(blacklist)
+            body = json.dumps({'ids': [int(item_id) for item_id in item_ids]})
+            log.info("Sending bulk DELETE request to {} for {} items".format(url,len(item_ids)))
+            try:
+                r = self.session.delete(url, data=body, timeout=30)
+            except Exception as e:
+                raise HTTP_MethodError('Error Connecting to server: {}'.format(e))
+            
+            log.info ("HTTP {}: {}".format(r.status_code,httpErrors[r.status_code]))
+            if r.status_code == 200: #200 = 'OK'
+                self.drop_from_queue(item_ids)
+                return dict((item_id, True) for item_id in item_ids)
+            if r.status_code == 404 or r.status_code == 405:
+                log.warning("No bulk delete on {}, sending single deletes from now on".format(self.name))
+                self.bulk_delete = False
+            else:
+                log.error("Bulk delete on {} failed, sending single deletes".format(self.name))
+        
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.fanout) as executor:
+            futures = dict((executor.submit(self.delete_queueitem, item_id, blacklist), item_id) for item_id in item_ids)
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result() is not False
+                except Exception as e:
+                    log.error("Unable to delete item {}: {}".format(futures[future],e))
+                    results[futures[future]] = False
+        return results
+
+
+class AsyncMediaserver(object):
+    """ Non-blocking front for a Mediaserver
+
+        Every call runs on a bounded thread pool and returns a Deferred, so a slow
+        or unreachable server never blocks the reactor thread of deluged. Calls
+        to a server whose circuit is open fail at once with CircuitOpenError.
+    """
+    def __init__(self, server, pool):
+        self.server  = server
+        self.pool    = pool
+        self.type    = server.type
+        self.name    = server.name
+        self.breaker = CircuitBreaker()
+
+    @property
+    def queue_time(self):
+        return self.server.queue_time
+
+    @property
+    def queue_version(self):
+        return self.server.queue_version
+
+    def _call(self, f, *args, **kwargs):
+        if not self.breaker.allow():
+            return defer.fail(CircuitOpenError('Circuit open for {}, retry in {:.0f} s'.format(self.name,self.breaker.status()['retry_in'])))
+        d = threads.deferToThreadPool(reactor, self.pool, f, *args, **kwargs)
+
+        def ok(result):
+            self.breaker.success()
+            return result
+
+        def failed(failure):
+            log.warning("Call to {} failed: {}".format(self.name,failure.getErrorMessage()))
+            self.breaker.failure()
+            return failure
+
+        return d.addCallbacks(ok, failed)
+
+    def get_queue(self, max_age=None):
+        """ Get queue, from the cache when it is younger than max_age seconds.
+            Without max_age the queue is always synced.
+        """
+        if max_age is not None:
+            queue = self.server.cached_queue(max_age)
+            if queue is not None:
+                return defer.succeed(queue)
+        return self._call(self.server.get_queue)
+
+    def lookup(self, hashes, max_age=0):
+        queue = self.server.cached_queue(max_age, warm=True)
+        if queue is not None and all(queue.get(hash, {}).get('id') is not None for hash in hashes):
+            return defer.succeed(dict((hash, queue[hash]) for hash in hashes))
+        return self._call(self.server.lookup, hashes, max_age)
+
+    def get_blacklist(self):
+        return self._call(self.server.get_blacklist)
+
+    def delete_blacklist_item(self, item_id):
+        return self._call(self.server.delete_blacklist_item, item_id)
+
+    def delete_queueitem(self, item_id, blacklist = 'true'):
+        return self._call(self.server.delete_queueitem, item_id, blacklist)
+
+    def delete_queueitems(self, item_ids, blacklist = 'true'):
+        return self._call(self.server.delete_queueitems, item_ids, blacklist)
+
+    def apply_event(self, event):
+        return self.server.apply_event(event)
+
+
+class MediaserverRegistry(object):
+    """ The configured media server instances, in config order
+
+        Each instance has label patterns (shell style, e.g. 'tv-*') and the
+        first instance whose patterns match the label of a torrent is the one
+        that torrent is removed through. Disabled instances still claim their
+        labels, their torrents are then removed by deluge itself.
+    """
+    def __init__(self):
+        self.servers = []
+        self.enabled = set()
+        self.patterns = {}
+        self._routes = {}
+
+    def add(self, server, labels, enabled=True):
+        if self.get(server.name) is not None:
+            raise Exception('Duplicate media server name: {}'.format(server.name))
+        self.servers.append(server)
+        self.patterns[server.name] = [label.lower() for label in labels]
+        if enabled:
+            self.enabled.add(server.name)
+        self._routes = {}
+
+    def get(self, name):
+        for server in self.servers:
+            if server.name == name:
+                return server
+        return None
+
+    def active(self):
+        """ Returns the enabled instances """
+        return [server for server in self.servers if server.name in self.enabled]
+
+    def is_enabled(self, server):
+        return server.name in self.enabled
+
+    def route(self, label):
+        """ Returns the instance that handles torrents with label, or None
+        """
+        if not label:
+            return None
+        try:
+            return self._routes[label]
+        except KeyError:
+            found = None
+            for server in self.servers:
+                if any(fnmatch.fnmatchcase(label.lower(), pattern) for pattern in self.patterns[server.name]):
+                    found = server
+                    break
+            self._routes[label] = found
+            return found
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def __len__(self):
+        return len(self.servers)
+
+
+def create_pool(maxthreads=4):
+    """ Create and start the thread pool used by AsyncMediaserver
+    """
+    pool = ThreadPool(minthreads=0, maxthreads=maxthreads, name='autoremoveplus-mediaserver')
+    pool.start()
+    return pool
+
 
 def main(server,mode='queue',item=None):
     
@@ -0,0 +1,592 @@
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+
+"""policy.py: torrent snapshots and removal metrics for autoremove plus."""
+
+__author__      = "Jools"
+__email__       = "springjools@gmail.com"
+__copyright__   = "Copyright 2019"
+
+# Deluge is free software.
+#
+# You may redistribute it and/or modify it under the terms of the
+# GNU General Public License, as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# deluge is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with deluge.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+#
+
+from collections import namedtuple
+import heapq
+import re
+
+import logging
+log = logging.getLogger(__name__)
+
+# Status keys the action phase of do_remove always reads
+BASE_STATUS_KEYS = (
+    'name',
+    'hash',
+    'time_added',
+    'seeding_time',
+    'ratio',
+    'is_finished',
+    'paused'
+)
+
+# Status key each remove rule reads
+METRIC_STATUS_KEYS = {
+    'func_ratio': 'ratio',
+    'func_added': 'time_added',
+    'func_seed_time': 'seeding_time',
+    'func_seeders': 'total_seeds',
+    'func_availability': 'distributed_copies'
+}
+
+
+class TorrentSnapshot(namedtuple('TorrentSnapshot', ['id', 'status', 'label', 'now'])):
+    """Status of one torrent, taken once per cycle.
+
+    ``status`` holds every key the active policy reads, ``label`` is the
+    Label plugin label ('' if none) and ``now`` is the timestamp shared by
+    all snapshots of the cycle.
+    """
+    __slots__ = ()
+
+
+def status_keys(metrics):
+    """Returns the status keys needed to evaluate the given remove rules"""
+    keys = list(BASE_STATUS_KEYS)
+    for metric in metrics:
+        key = METRIC_STATUS_KEYS.get(metric)
+        if key is not None and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def take_snapshot(torrent_id, torrent, keys, label, now):
+    return TorrentSnapshot(torrent_id, torrent.get_status(keys), label, now)
+
+
+def _get_ratio(s):
+    return s.status['ratio']
+
+def _age_in_days(s):
+    return (s.now - s.status['time_added'])/86400.0
+
+
+# Add key label also to get_remove_rules() in core.py
+filter_funcs = {
+    'func_ratio': _get_ratio,
+    'func_added': _age_in_days,
+    'func_seed_time': lambda s: s.status['seeding_time'] / 86400.0,
+    'func_seeders': lambda s: s.status['total_seeds'],
+    'func_availability': lambda s: s.status['distributed_copies']
+}
+
+# Relative cost of each metric. Seeders and availability come from tracker
+# and peer state, the others are plain fields of the torrent.
+filter_costs = {
+    'func_ratio': 1,
+    'func_added': 1,
+    'func_seed_time': 1,
+    'func_seeders': 10,
+    'func_availability': 10
+}
+
+# Metrics costing this much are only read when they can change the outcome
+EXPENSIVE_COST = 10
+
+def metric_cost(metric):
+    return filter_costs.get(metric, filter_costs['func_ratio'])
+
+def is_expensive(metric):
+    return metric_cost(metric) >= EXPENSIVE_COST
+
+sel_funcs = {
+    'and': lambda tup: tup[0] and tup[1],
+    'or': lambda tup: tup[0] or tup[1]
+}
+
+
+class EvalState(object):
+    """What earlier cycles learned about one torrent.
+
+    ``exempt`` and ``ruleset`` hold the result of the exemption scan and
+    the specific rules found for ``label`` and the tracker urls in
+    ``trackers``. ``next_check`` is the time until which re-evaluating the
+    remove conditions cannot change the outcome.
+    """
+    __slots__ = ('label', 'trackers', 'exempt', 'ruleset', 'next_check')
+
+    def __init__(self, label, trackers, exempt, ruleset):
+        self.label = label
+        self.trackers = trackers
+        self.exempt = exempt
+        self.ruleset = ruleset
+        self.next_check = 0.0
+
+
+def is_seeding(s):
+    return s.status['is_finished'] and not s.status['paused']
+
+def metric_rate(metric, s):
+    """Returns how fast a remove rule metric grows per second, or None if it
+    cannot be predicted from the snapshot"""
+    if metric == 'func_added':
+        return 1/86400.0
+    if metric == 'func_seed_time':
+        # paused or queued torrents don't seed, an upper bound is good enough
+        return 1/86400.0 if is_seeding(s) else 0.0
+    return None
+
+def crossing_time(value, threshold, rate, now):
+    """Returns when a metric growing at rate goes past threshold"""
+    if rate is None:
+        return now
+    if value > threshold or rate <= 0:
+        return float('inf')
+    # one second of slack so the comparison has flipped when we look again
+    return now + (threshold - value) / rate + 1.0
+
+def next_check(s, metric_cache, conditions):
+    """Returns the earliest time any of the (metric, threshold) conditions
+    can change its outcome for the torrent of snapshot s"""
+    rates = [metric_rate(metric, s) for (metric, _) in conditions]
+    # one unpredictable metric means looking again next cycle, and none
+    # of the metrics has to be read to know that
+    if None in rates:
+        return s.now
+    deadline = float('inf')
+    for (metric, threshold), rate in zip(conditions, rates):
+        deadline = min(deadline, crossing_time(
+            metric_cache.get(s, metric),
+            threshold,
+            rate,
+            s.now
+        ))
+    return deadline
+
+
+class PolicySpec(namedtuple('PolicySpec', [
+        'enabled', 'filter', 'filter2', 'sel_func', 'min_val', 'max_val2',
+        'rule_1', 'rule_2', 'remove', 'seedtime_limit', 'seedtime_pause',
+        'pause_seed'])):
+    """The remove policy settings decide() needs, with the hit and run
+    limits applied. Picklable, so it can be sent to worker processes."""
+    __slots__ = ()
+
+
+# What decide() wants done with a torrent
+ACT_REMOVE = 'remove'           # unfinished, through its media server or locally
+ACT_PAUSE = 'pause'             # unfinished, when removing is turned off
+ACT_SEED_REMOVE = 'seed_remove' # finished and seeded long enough
+ACT_SEED_PAUSE = 'seed_pause'   # finished and seeded past the pause limit
+
+# ``next_check`` is None when the torrent was acted on, or nothing may
+# be learned about it, and its evaluation state is left as it is
+Decision = namedtuple('Decision', ['action', 'next_check'])
+
+NO_DECISION = Decision(None, None)
+
+
+def general_filter(s, spec, metric_cache, n):
+    """Returns the result of the first or second general condition test"""
+    if n == 1:
+        return metric_cache.get(s, spec.filter) <= spec.min_val
+    return metric_cache.get(s, spec.filter2) >= spec.max_val2
+
+
+def remove_condition(s, ruleset, spec, metric_cache):
+    """Returns whether the remove rules hold for the torrent of snapshot s.
+
+    Specific rules replace the general ones. Only the tests that can
+    change the outcome are evaluated, the cheapest first.
+    """
+    if ruleset:
+        remove_cond = ruleset.holds(s, metric_cache)
+        metric_cache.count_avoided(s, ruleset.expensive)
+        return remove_cond
+    if spec.rule_1 and spec.rule_2:
+        # If both rules active use custom logical function
+        if spec.sel_func not in sel_funcs:
+            raise ValueError('Unknown logical operator {}'.format(spec.sel_func))
+        first, second = (1, 2) if metric_cost(spec.filter) <= metric_cost(spec.filter2) else (2, 1)
+        remove_cond = general_filter(s, spec, metric_cache, first)
+        # False settles an and, True settles an or
+        if remove_cond != (spec.sel_func == 'or'):
+            remove_cond = general_filter(s, spec, metric_cache, second)
+        metric_cache.count_avoided(s, [m for m in (spec.filter, spec.filter2) if is_expensive(m)])
+        return remove_cond
+    if spec.rule_1:
+        return general_filter(s, spec, metric_cache, 1)
+    if spec.rule_2:
+        return general_filter(s, spec, metric_cache, 2)
+    return False
+
+
+def decide(s, ruleset, spec, metric_cache):
+    """Returns the Decision for the torrent of snapshot s under its
+    specific rule set and the policy spec"""
+    if not spec.enabled:
+        return NO_DECISION
+
+    remove_cond = remove_condition(s, ruleset, spec, metric_cache)
+    seedtime = s.status['seeding_time'] / 3600.0 # seed time in hours
+    paused = s.status['paused']
+
+    # conditions deciding what happens to the torrent, with the
+    # seed time thresholds expressed in days like func_seed_time
+    if ruleset:
+        conditions = [(rule[1], rule[2]) for rule in ruleset.rules]
+    elif s.status['is_finished']:
+        conditions = []
+    else:
+        conditions = []
+        if spec.rule_1:
+            conditions.append((spec.filter, spec.min_val))
+        if spec.rule_2:
+            conditions.append((spec.filter2, spec.max_val2))
+
+    if not s.status['is_finished']:
+        if remove_cond:
+            if spec.remove:
+                return Decision(ACT_REMOVE, None)
+            return Decision(None if paused else ACT_PAUSE, None)
+    else:
+        conditions.append(('func_seed_time', spec.seedtime_limit / 24.0))
+        conditions.append(('func_seed_time', spec.seedtime_pause / 24.0))
+        if not ruleset or remove_cond:
+            if seedtime > spec.seedtime_limit:
+                if not spec.pause_seed:
+                    return Decision(ACT_SEED_REMOVE, None)
+            elif seedtime > spec.seedtime_pause and not paused:
+                return Decision(ACT_SEED_PAUSE, None)
+
+    # nothing to do, so skip the torrent until a threshold is crossed
+    return Decision(None, next_check(s, metric_cache, conditions))
+
+
+def evaluate_shard(spec, items):
+    """Decides on a shard of (snapshot, rule set) pairs in a worker process.
+
+    Returns the decisions and errors by torrent id, and the metric cache
+    counters of the shard.
+    """
+    metric_cache = MetricCache()
+    decisions = {}
+    errors = {}
+    for s, ruleset in items:
+        try:
+            decisions[s.id] = decide(s, ruleset, spec, metric_cache)
+        except Exception as e:
+            errors[s.id] = '{}'.format(e)
+    return decisions, errors, metric_cache.stats()
+
+
+class MetricCache(object):
+    """Remove rule metrics of one cycle, keyed by (torrent id, metric).
+
+    Shared by the sort and the rule checks so every metric is evaluated at
+    most once per torrent per cycle. Status keys left out of a snapshot
+    are read with ``loader(torrent_id, keys)`` when a metric needs them.
+    ``expensive`` counts the expensive metrics read, ``avoided`` the ones
+    short-circuit evaluation did not need.
+    """
+
+    def __init__(self, loader=None):
+        self.loader = loader
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+        self.expensive = 0
+        self.avoided = 0
+
+    def get(self, s, metric):
+        key = (s.id, metric)
+        try:
+            value = self.values[key]
+        except KeyError:
+            self.misses += 1
+            if is_expensive(metric):
+                self.expensive += 1
+            status_key = METRIC_STATUS_KEYS.get(metric)
+            if self.loader is not None and status_key is not None and status_key not in s.status:
+                s.status.update(self.loader(s.id, [status_key]))
+            value = filter_funcs.get(metric, _get_ratio)(s)
+            self.values[key] = value
+        else:
+            self.hits += 1
+        return value
+
+    def count_avoided(self, s, metrics):
+        """Counts the expensive metrics a decision on s did without"""
+        for metric in metrics:
+            if (s.id, metric) not in self.values:
+                self.avoided += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expensive': self.expensive,
+            'avoided': self.avoided
+        }
+
+
+class SubstringMatcher(object):
+    """Matches text against a list of lower cased substrings.
+
+    The patterns are compiled into one regular expression, so a lookup is a
+    single scan that stops at the first hit. Results are remembered per text
+    since many torrents share the same announce urls and labels.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [p.lower() for p in patterns]
+        if self.patterns:
+            self._regex = re.compile('|'.join(re.escape(p) for p in self.patterns))
+        else:
+            self._regex = None
+        self._seen = {}
+
+    def search(self, text):
+        """Returns the matching pattern found in text, or None"""
+        if self._regex is None:
+            return None
+        try:
+            return self._seen[text]
+        except KeyError:
+            match = self._regex.search(text)
+            found = match.group(0) if match is not None else None
+            self._seen[text] = found
+            return found
+
+    def search_any(self, texts):
+        """Returns the first match found in any of texts, or None"""
+        if self._regex is None:
+            return None
+        for text in texts:
+            found = self.search(text)
+            if found is not None:
+                return found
+        return None
+
+
+class RuleSet(object):
+    """The specific rules of a torrent, compiled for evaluation.
+
+    Rules are sorted on their logical operator, so AND is evaluated first,
+    and the first rule is the seed of the fold. That makes the fold the
+    AND of the seed and the other AND rules, ORed with the OR rules. Each
+    group is checked cheapest metric first and stops at the first check
+    that settles it. Picklable, so it can be sent to worker processes.
+    """
+    __slots__ = ('rules', 'all_of', 'any_of', 'expensive', 'error')
+
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda rule: rule[0])
+        head, tail = self.rules[:1], self.rules[1:]
+        self.all_of = self._by_cost(head + [r for r in tail if r[0] == 'and'])
+        self.any_of = self._by_cost([r for r in tail if r[0] == 'or'])
+        self.expensive = tuple(set(rule[1] for rule in self.rules if is_expensive(rule[1])))
+        unknown = [rule[0] for rule in tail if rule[0] not in sel_funcs]
+        self.error = 'Unknown logical operator {}'.format(unknown[0]) if unknown else None
+
+    @staticmethod
+    def _by_cost(rules):
+        return tuple(sorted(((rule[1], rule[2]) for rule in rules), key=lambda c: metric_cost(c[0])))
+
+    def __len__(self):
+        return len(self.rules)
+
+    def holds(self, s, metric_cache):
+        if self.error is not None:
+            raise ValueError(self.error)
+        get = metric_cache.get
+        for metric, threshold in self.all_of:
+            if not get(s, metric) >= threshold:
+                break
+        else:
+            return True
+        for metric, threshold in self.any_of:
+            if get(s, metric) >= threshold:
+                return True
+        return False
+
+
+NO_RULES = RuleSet([])
+
+
+class RuleBook(object):
+    """tracker_rules and label_rules, compiled once per config.
+
+    The tracker names found in each announce url are remembered, and the
+    RuleSet of each distinct (tracker names, label) pair is built once and
+    shared by all torrents with those trackers and that label.
+    """
+
+    def __init__(self, tracker_rules, label_rules):
+        self.tracker_rules = tracker_rules
+        self.label_rules = label_rules
+        self.names = [(name, name.lower()) for name in tracker_rules]
+        self._url_names = {}
+        self._rulesets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def url_names(self, url):
+        """Returns the tracker names of tracker_rules found in url"""
+        try:
+            return self._url_names[url]
+        except KeyError:
+            found = tuple(name for (name, lower) in self.names if url.find(lower) != -1)
+            self._url_names[url] = found
+            return found
+
+    def lookup(self, trackers, label):
+        """Returns the RuleSet of a torrent with the given trackers and label"""
+        names = set()
+        for tracker in trackers:
+            names.update(self.url_names(tracker['url']))
+        if not (label and label in self.label_rules):
+            label = ''
+        key = (frozenset(names), label)
+        try:
+            ruleset = self._rulesets[key]
+        except KeyError:
+            self.misses += 1
+            rules = []
+            for name, _ in self.names:
+                if name in names:
+                    rules.extend(self.tracker_rules[name])
+            if label:
+                rules.extend(self.label_rules[label])
+            ruleset = RuleSet(rules) if rules else NO_RULES
+            self._rulesets[key] = ruleset
+        else:
+            self.hits += 1
+        return ruleset
+
+    def stats(self):
+        return {'rulesets': len(self._rulesets), 'hits': self.hits, 'misses': self.misses}
+
+
+class Policy(namedtuple('Policy', [
+        'spec', 'max_seeds', 'count_exempt', 'remove_data', 'keys',
+        'lazy_keys', 'tracker_matcher', 'label_matcher', 'rulebook'])):
+    """The remove policy of a config, compiled once by compile_policy().
+
+    A cycle reads nothing else of the config, and keeps the Policy it
+    started with when a new config replaces it. ``lazy_keys`` are the
+    expensive keys of ``keys`` that only specific rules read, they can be
+    left out of snapshots and read when a rule gets to them.
+    """
+    __slots__ = ()
+
+
+def compile_policy(config, defaults):
+    """Returns the Policy of the config dict, with the keys it lacks or
+    holds invalid values for taken from defaults"""
+    def get(key, convert=None):
+        value = config.get(key, defaults[key])
+        if convert is None:
+            return value
+        try:
+            return convert(value)
+        except (TypeError, ValueError):
+            log.warning("Invalid value {!r} for {}, using {!r}".format(value, key, defaults[key]))
+            return convert(defaults[key])
+
+    def metric(key):
+        name = get(key)
+        if name not in filter_funcs:
+            # evaluated as the ratio anyway, say so once
+            log.warning("Unknown remove rule {} for {}, using func_ratio".format(name, key))
+            return 'func_ratio'
+        return name
+
+    spec = PolicySpec(
+        enabled=get('enabled', bool),
+        filter=metric('filter'),
+        filter2=metric('filter2'),
+        sel_func=get('sel_func'),
+        min_val=get('min', float),
+        #prevent hit & run
+        max_val2=max(get('min2', float), 0.5),
+        rule_1=get('rule_1_enabled', bool),
+        rule_2=get('rule_2_enabled', bool),
+        remove=get('remove', bool),
+        seedtime_limit=max(get('seedtime_limit', float), 24.0),
+        seedtime_pause=max(get('seedtime_pause', float), 20.0),
+        pause_seed=get('pause_seed', bool)
+    )
+    if spec.rule_1 and spec.rule_2 and spec.sel_func not in sel_funcs:
+        log.error("Unknown logical operator {}, no torrent will be removed".format(spec.sel_func))
+
+    tracker_rules = get('tracker_rules') or {}
+    label_rules = get('label_rules') or {}
+    # every status key the remove rules need is read in one go per torrent
+    metrics = [spec.filter, spec.filter2]
+    for rules in list(tracker_rules.values()) + list(label_rules.values()):
+        metrics.extend(rule[1] for rule in rules)
+    # the sort reads the general filters of every torrent anyway
+    lazy_keys = set(
+        METRIC_STATUS_KEYS[metric] for metric in metrics
+        if metric in METRIC_STATUS_KEYS and is_expensive(metric)
+        and metric not in (spec.filter, spec.filter2)
+    )
+
+    return Policy(
+        spec=spec,
+        max_seeds=get('max_seeds', int),
+        count_exempt=get('count_exempt', bool),
+        remove_data=get('remove_data', bool),
+        keys=tuple(status_keys(metrics)),
+        lazy_keys=frozenset(lazy_keys),
+        tracker_matcher=SubstringMatcher(get('trackers') or []),
+        label_matcher=SubstringMatcher(get('labels') or []),
+        rulebook=RuleBook(tracker_rules, label_rules)
+    )
+
+
+def sort_candidates(items, key, keep):
+    """Returns the removal candidates by sorting the whole list.
+
+    These are the items beyond the first ``keep`` of the ascending sort,
+    highest first, the order do_remove processes them in.
+    """
+    return list(reversed(sorted(items, key=key)[keep:]))
+
+
+def select_candidates(items, key, keep):
+    """Returns the same candidates as sort_candidates() in O(n log k).
+
+    Only the ``len(items) - keep`` largest items are kept in a heap. Ties
+    are broken on the position in ``items`` so equal keys come out in the
+    order the stable full sort would give them.
+    """
+    count = len(items) - keep
+    if count <= 0:
+        return []
+    # a heap only pays off while the tail is small compared to the library
+    if count * 16 > len(items):
+        return sort_candidates(items, key, keep)
+    best = heapq.nlargest(
+        count,
+        enumerate(items),
+        key=lambda p: (key(p[1]), p[0])
+    )
+    return [item for (_, item) in best]
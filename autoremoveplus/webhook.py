@@ -0,0 +1,83 @@
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+
+"""webhook.py: receives sonarr/lidarr/radarr webhooks for autoremove plus."""
+
+__author__      = "Jools"
+__email__       = "springjools@gmail.com"
+__copyright__   = "Copyright 2019"
+
+# Deluge is free software.
+#
+# You may redistribute it and/or modify it under the terms of the
+# GNU General Public License, as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# deluge is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with deluge.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+#
+
+import json
+import logging
+log = logging.getLogger(__name__)
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+
+class WebhookResource(resource.Resource):
+    """Accepts webhook posts on /<server name>, e.g. http://host:port/sonarr
+
+    Each event updates the cached queue of the matching Mediaserver. If a
+    token is set, it has to be passed as ?token=... in the webhook url.
+    """
+    isLeaf = True
+
+    def __init__(self, servers, token=None):
+        resource.Resource.__init__(self)
+        self.servers = servers
+        self.token = token
+
+    def render_POST(self, request):
+        name = request.postpath[0].decode('utf-8') if request.postpath else ''
+        mediaserver = self.servers.get(name)
+        if mediaserver is None:
+            request.setResponseCode(404)
+            return b''
+
+        if self.token and request.args.get(b'token', [b''])[0].decode('utf-8') != self.token:
+            log.warning("Webhook for {} with a wrong token from {}".format(name, request.getClientAddress()))
+            request.setResponseCode(403)
+            return b''
+
+        try:
+            event = json.loads(request.content.read().decode('utf-8'))
+        except Exception as e:
+            log.warning("Cannot decode webhook for {}: {}".format(name, e))
+            request.setResponseCode(400)
+            return b''
+
+        log.info("Webhook {} from {}".format(event.get('eventType'), name))
+        mediaserver.apply_event(event)
+        return b''
+
+
+def listen(servers, port, interface='127.0.0.1', token=None):
+    """Starts the webhook listener, returns the listening port"""
+    log.info("Listening for webhooks on {}:{}".format(interface, port))
+    return reactor.listenTCP(
+        port,
+        server.Site(WebhookResource(servers, token)),
+        interface=interface
+    )
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""bench_engines.py: check that the remove policy engines agree, and time them.
+
+Random snapshots, policy specs and specific rules are decided on with
+policy.decide() one torrent at a time, with evaluate_shard() as a worker
+process runs it and, if numpy is installed, with columnar.Columns.decide().
+Any difference in actions, next check times or errors is an error.
+"""
+
+import argparse
+import multiprocessing
+import pickle
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from autoremoveplus import columnar
+from autoremoveplus.policy import TorrentSnapshot, PolicySpec, RuleSet, MetricCache
+from autoremoveplus.policy import decide, evaluate_shard, filter_funcs
+
+METRICS = sorted(filter_funcs)
+
+
+def make_snapshots(count, rnd, now):
+    snapshots = []
+    for n in range(count):
+        status = {
+            # coarse values so that plenty of them sit on a threshold
+            'ratio': round(rnd.uniform(0.0, 5.0), rnd.choice([0, 1, 2])),
+            'time_added': now - rnd.randint(0, 60) * 86400 - rnd.randint(0, 86400),
+            'seeding_time': rnd.choice([0, rnd.randint(0, 400) * 3600]),
+            'is_finished': rnd.random() < 0.6,
+            'paused': rnd.random() < 0.2,
+            'total_seeds': rnd.randint(0, 50),
+            'distributed_copies': round(rnd.uniform(0.0, 10.0), 1)
+        }
+        snapshots.append(TorrentSnapshot('{:040x}'.format(rnd.getrandbits(160)), status, '', now))
+    return snapshots
+
+
+def make_spec(rnd):
+    return PolicySpec(
+        enabled=rnd.random() < 0.95,
+        filter=rnd.choice(METRICS),
+        filter2=rnd.choice(METRICS),
+        # now and then an operator neither engine knows
+        sel_func=rnd.choice(['and', 'or', 'and', 'or', 'xor']),
+        min_val=rnd.uniform(0.0, 3.0),
+        max_val2=max(rnd.uniform(0.0, 30.0), 0.5),
+        rule_1=rnd.random() < 0.8,
+        rule_2=rnd.random() < 0.8,
+        remove=rnd.random() < 0.7,
+        seedtime_limit=max(rnd.uniform(0.0, 300.0), 24.0),
+        seedtime_pause=max(rnd.uniform(0.0, 200.0), 20.0),
+        pause_seed=rnd.random() < 0.3
+    )
+
+
+def make_rule_sets(count, rnd):
+    """Returns the RuleSet of every snapshot, drawn from a few shared ones"""
+    def rule():
+        return [rnd.choice(['and', 'or', 'and', 'or', 'AND']), rnd.choice(METRICS), round(rnd.uniform(0.0, 20.0), 1)]
+    shared = [RuleSet([])] + [RuleSet([rule() for _ in range(rnd.randint(1, 4))]) for _ in range(rnd.randint(0, 4))]
+    return [rnd.choice(shared) for _ in range(count)]
+
+
+def decide_each(snapshots, rule_sets, spec):
+    metric_cache = MetricCache()
+    decisions = {}
+    errors = {}
+    for s, ruleset in zip(snapshots, rule_sets):
+        try:
+            decisions[s.id] = decide(s, ruleset, spec, metric_cache)
+        except Exception as e:
+            errors[s.id] = '{}'.format(e)
+    return decisions, errors
+
+
+def decide_shards(snapshots, rule_sets, spec, shard_size, pool):
+    items = list(zip(snapshots, rule_sets))
+    shards = [items[n:n + shard_size] for n in range(0, len(items), shard_size)]
+    if pool is not None:
+        results = list(pool.map(evaluate_shard, [spec] * len(shards), shards))
+    else:
+        # what a worker process gets, without starting one
+        results = [evaluate_shard(*pickle.loads(pickle.dumps((spec, shard)))) for shard in shards]
+    decisions = {}
+    errors = {}
+    for shard_decisions, shard_errors, stats in results:
+        decisions.update(shard_decisions)
+        errors.update(shard_errors)
+    return decisions, errors
+
+
+def decide_columns(snapshots, rule_sets, spec, now):
+    columns = columnar.Columns(snapshots, now)
+    return columns.decide(rule_sets, spec, range(len(snapshots)))
+
+
+def compare(name, expected, got, trial):
+    if got != expected:
+        decisions, errors = expected
+        for torrent_id in set(decisions) | set(got[0]):
+            if decisions.get(torrent_id) != got[0].get(torrent_id):
+                raise AssertionError("Trial {}: {} decides {} on {}, expected {}".format(
+                    trial, name, got[0].get(torrent_id), torrent_id, decisions.get(torrent_id)))
+        raise AssertionError("Trial {}: {} errors {}, expected {}".format(trial, name, got[1], errors))
+
+
+def main(args):
+    rnd = random.Random(args.seed)
+    use_numpy = columnar.available() and not args.no_numpy
+    if not use_numpy:
+        print("numpy is not installed, comparing without Columns.decide()")
+    pool = None
+    if args.processes:
+        pool = ProcessPoolExecutor(max_workers=args.processes, mp_context=multiprocessing.get_context('spawn'))
+    times = {'decide': 0.0, 'evaluate_shard': 0.0, 'columns': 0.0}
+    decided = 0
+    try:
+        for trial in range(args.trials):
+            now = time.time()
+            count = rnd.randint(1, args.torrents)
+            snapshots = make_snapshots(count, rnd, now)
+            rule_sets = make_rule_sets(count, rnd)
+            spec = make_spec(rnd)
+
+            start = time.time()
+            expected = decide_each(snapshots, rule_sets, spec)
+            times['decide'] += time.time() - start
+
+            start = time.time()
+            compare('evaluate_shard', expected, decide_shards(snapshots, rule_sets, spec, args.shard_size, pool), trial)
+            times['evaluate_shard'] += time.time() - start
+
+            if use_numpy:
+                start = time.time()
+                compare('Columns.decide', expected, decide_columns(snapshots, rule_sets, spec, now), trial)
+                times['columns'] += time.time() - start
+            decided += count
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print("{} trials, {} torrents: all engines agree".format(args.trials, decided))
+    for name in ('decide', 'evaluate_shard', 'columns'):
+        if times[name]:
+            print("{:>15} {:>10.1f} ms {:>12.0f} torrents/s".format(name, times[name] * 1000, decided / times[name]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the remove policy engines decide alike')
+    parser.add_argument('--trials', type=int, default=200, help='random libraries and policies')
+    parser.add_argument('--torrents', type=int, default=2000, help='largest library of a trial')
+    parser.add_argument('--shard-size', type=int, default=500, help='torrents per evaluate_shard call')
+    parser.add_argument('--processes', type=int, default=0, help='worker processes for evaluate_shard, 0 to call it here')
+    parser.add_argument('--no-numpy', action='store_true', help='leave Columns.decide() out')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""bench_mediaserver.py: time Mediaserver queue syncs and deletes against a fake server."""
+
+import argparse
+import time
+
+from autoremoveplus.mediaserver import Mediaserver
+from benchmarks import fakearr
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def bench_get_queue(url, args):
+    print("get_queue: {} {} records, page size {}, {} runs".format(args.type, args.queue_size, args.page_size, args.repeat))
+    print("{:>7} {:>9} {:>9} {:>9} {:>10} {:>10} {:>10} {:>12} {:>10} {:>10}".format(
+        'fanout', 'records', 'requests', 'MB', 'min (ms)', 'p50 (ms)', 'max (ms)', 'records/s', 'lost pages', 'lost syncs'))
+    for fanout in args.fanouts:
+        server = Mediaserver(url, None, args.type, args.page_size, fanout, api_version=args.api_version)
+        times = []
+        failed = 0
+        errors = 0
+        records = 0
+        for _ in range(args.repeat):
+            start = time.time()
+            try:
+                records = len(server.get_queue())
+            except Exception:
+                # the first page or the unpaged queue failed, nothing synced
+                errors += 1
+                continue
+            times.append(time.time() - start)
+            failed += len(server.failed_pages)
+        if not times:
+            print("{:>7} every sync failed".format(fanout))
+            continue
+        print("{:>7} {:>9} {:>9.1f} {:>9.2f} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.0f} {:>10} {:>10}".format(
+            fanout,
+            records,
+            server.requests_sent / args.repeat,
+            server.bytes_received / args.repeat / 1e6,
+            min(times) * 1000,
+            percentile(times, 0.5) * 1000,
+            max(times) * 1000,
+            records / percentile(times, 0.5),
+            failed,
+            errors
+        ))
+
+
+def bench_delete(url, fake, args):
+    server = Mediaserver(url, None, args.type, args.page_size, max(args.fanouts), api_version=args.api_version)
+    ids = [str(record['id']) for record in fake.queue()]
+    single, batch = ids[:args.deletes], ids[args.deletes:2 * args.deletes]
+
+    times = []
+    failed = 0
+    start = time.time()
+    for item_id in single:
+        t = time.time()
+        if server.delete_queueitem(item_id) is False:
+            failed += 1
+        times.append(time.time() - t)
+    elapsed = time.time() - start
+    print("delete_queueitem: {} items, {:.1f} items/s, p50 {:.1f} ms, p95 {:.1f} ms, max {:.1f} ms, {} failed".format(
+        len(single), len(single) / elapsed, percentile(times, 0.5) * 1000, percentile(times, 0.95) * 1000, max(times) * 1000, failed))
+
+    if batch:
+        start = time.time()
+        results = server.delete_queueitems(batch)
+        elapsed = time.time() - start
+        print("delete_queueitems: {} items in {:.1f} ms, {:.1f} items/s, {} failed".format(
+            len(batch), elapsed * 1000, len(batch) / elapsed, sum(1 for ok in results.values() if not ok)))
+
+
+def main(args):
+    fake = fakearr.from_arguments(args)
+    httpd = fakearr.start(fake)
+    try:
+        bench_get_queue(httpd.url, args)
+        if args.deletes:
+            bench_delete(httpd.url, fake, args)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    print("server requests: {}".format(', '.join('{}={}'.format(k, v) for k, v in sorted(fake.counts.items()))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Mediaserver against a fake sonarr/radarr/lidarr server')
+    parser.add_argument('--type', default='sonarr', choices=['sonarr', 'radarr', 'lidarr'], help='server type')
+    parser.add_argument('--api-version', type=int, default=None, help='api version, the default of the type if not set')
+    parser.add_argument('--page-size', type=int, default=250, help='page size asked for by the client')
+    parser.add_argument('--fanouts', type=int, nargs='+', default=[1, 4, 8], help='page requests in flight')
+    parser.add_argument('--repeat', type=int, default=5, help='queue syncs per fanout')
+    parser.add_argument('--deletes', type=int, default=100, help='items deleted one by one, and again in one batch')
+    fakearr.add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
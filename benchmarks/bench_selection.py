@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""bench_selection.py: compare full sort and top-k selection of removal candidates."""
+
+import argparse
+import random
+import time
+import timeit
+
+from autoremoveplus.policy import TorrentSnapshot, MetricCache
+from autoremoveplus.policy import sort_candidates, select_candidates
+
+
+def make_snapshots(count, seed=0):
+    rnd = random.Random(seed)
+    now = time.time()
+    snapshots = []
+    for n in range(count):
+        status = {
+            # coarse values so that plenty of keys tie
+            'ratio': round(rnd.uniform(0.0, 5.0), 1),
+            'time_added': now - rnd.randint(0, 60) * 86400,
+            'seeding_time': rnd.randint(0, 30 * 86400)
+        }
+        snapshots.append(TorrentSnapshot('{:040x}'.format(n), status, '', now))
+    return snapshots
+
+
+def main(count, tails, repeat, filter1, filter2):
+    snapshots = make_snapshots(count)
+    print("{} torrents, sort key = ({}, {})".format(count, filter1, filter2))
+    print("{:>8} {:>12} {:>12} {:>8}".format('tail', 'sort (ms)', 'select (ms)', 'speedup'))
+    for tail in tails:
+        keep = max(count - tail, 0)
+        cache = MetricCache()
+        key = lambda s: (cache.get(s, filter1), cache.get(s, filter2))
+        # warm the cache so both sides only pay for ordering
+        expected = sort_candidates(snapshots, key, keep)
+        if select_candidates(snapshots, key, keep) != expected:
+            raise AssertionError("Selection differs from full sort for tail {}".format(tail))
+        t_sort = min(timeit.repeat(lambda: sort_candidates(snapshots, key, keep), number=1, repeat=repeat))
+        t_select = min(timeit.repeat(lambda: select_candidates(snapshots, key, keep), number=1, repeat=repeat))
+        print("{:>8} {:>12.2f} {:>12.2f} {:>7.1f}x".format(tail, t_sort * 1000, t_select * 1000, t_sort / t_select))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark removal candidate selection')
+    parser.add_argument('--torrents', type=int, default=20000, help='number of torrents')
+    parser.add_argument('--tails', type=int, nargs='+', default=[10, 50, 200, 1000, 5000], help='number of candidates beyond max_seeds')
+    parser.add_argument('--repeat', type=int, default=5, help='timing repetitions')
+    parser.add_argument('--filter', default='func_ratio', help='primary remove rule')
+    parser.add_argument('--filter2', default='func_added', help='secondary remove rule')
+    args = parser.parse_args()
+    main(args.torrents, args.tails, args.repeat, args.filter, args.filter2)
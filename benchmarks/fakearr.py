@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""fakearr.py: stand-in sonarr/radarr/lidarr server for load and latency tests.
+
+Serves the queue and blacklist endpoints Mediaserver uses, from a generated
+queue of any size, on http://host:port/<type>/api[/v<version>]/... Latency,
+errors and slow responses can be injected to see how a sync strategy copes.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+
+
+PATH_RE = re.compile(r'^/(?P<type>sonarr|radarr|lidarr)/api(?:/v(?P<version>\d+))?/(?P<resource>queue|blacklist)(?:/(?P<item>[^/]+))?$')
+
+
+def make_record(n, rnd):
+    """Returns a queue record shaped like the ones the *arr servers send"""
+    size = rnd.randint(200, 8000) * 1024 * 1024
+    return {
+        'id': 1000000 + n,
+        'downloadId': '{:040X}'.format(rnd.getrandbits(160)),
+        'title': 'Some.Show.S{:02d}E{:02d}.1080p.WEB.h264-GROUP'.format(n // 100 % 100, n % 100),
+        'status': 'downloading',
+        'trackedDownloadStatus': 'ok',
+        'statusMessages': [],
+        'protocol': 'torrent',
+        'downloadClient': 'Deluge',
+        'indexer': 'Indexer',
+        'size': size,
+        'sizeleft': rnd.randint(0, size),
+        'timeleft': '00:{:02d}:00'.format(rnd.randint(0, 59)),
+        'estimatedCompletionTime': '2019-01-01T00:00:00Z',
+        'quality': {'quality': {'id': 3, 'name': 'WEBDL-1080p'}, 'revision': {'version': 1, 'real': 0}}
+    }
+
+
+class FakeArr(object):
+    """Queue and fault settings shared by all request handlers.
+
+    ``latency`` is added to every response, ``slow_rate`` of them take
+    ``slow_latency`` instead and ``error_rate`` of them fail with a 500.
+    ``max_page_size`` caps the pageSize a client asks for, like the real
+    servers do.
+    """
+
+    def __init__(self, queue_size=1000, max_page_size=1000, latency=0.0,
+                 error_rate=0.0, slow_rate=0.0, slow_latency=2.0, apikey=None,
+                 bulk_delete=True, seed=0):
+        self.max_page_size = max_page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.apikey = apikey
+        self.bulk_delete = bulk_delete
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.records = [make_record(n, self.rnd) for n in range(queue_size)]
+        self.counts = {}
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def fault(self):
+        """Sleeps the injected latency, returns True if the request should fail"""
+        with self.lock:
+            slow = self.rnd.random() < self.slow_rate
+            failed = self.rnd.random() < self.error_rate
+        delay = self.slow_latency if slow else self.latency
+        if delay:
+            time.sleep(delay)
+        return failed
+
+    def page(self, page, page_size, descending=False):
+        """The records are kept in ascending time left order, the last ones
+        stand for stalled downloads"""
+        page_size = max(1, min(page_size, self.max_page_size))
+        with self.lock:
+            total = len(self.records)
+            records = self.records[::-1] if descending else self.records
+            records = records[(page - 1) * page_size:page * page_size]
+        return {
+            'page': page,
+            'pageSize': page_size,
+            'sortKey': 'timeleft',
+            'sortDirection': 'descending' if descending else 'ascending',
+            'totalRecords': total,
+            'records': records
+        }
+
+    def queue(self):
+        with self.lock:
+            return list(self.records)
+
+    def delete(self, item_ids):
+        """Deletes queue items by id, returns the ids that were found"""
+        item_ids = set(item_ids)
+        with self.lock:
+            found = set(record['id'] for record in self.records if record['id'] in item_ids)
+            self.records = [record for record in self.records if record['id'] not in found]
+        return found
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive, so a client session reuses its connections
+    protocol_version = 'HTTP/1.1'
+    # don't let small responses wait for delayed acks
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self):
+        """Returns the path match and query of a request, or None once the
+        request has been answered with an error"""
+        fake = self.server.fake
+        parts = urlsplit(self.path)
+        match = PATH_RE.match(parts.path)
+        if match is None:
+            self.reply(404)
+            return None
+        if fake.apikey and self.headers.get('x-api-key') != fake.apikey:
+            self.reply(401, {'error': 'Unauthorized'})
+            return None
+        if fake.fault():
+            fake.count('error')
+            self.reply(500, {'message': 'Injected error'})
+            return None
+        return match, parse_qs(parts.query)
+
+    def do_GET(self):
+        routed = self.route()
+        if routed is None:
+            return
+        fake, (match, query) = self.server.fake, routed
+        if match.group('resource') == 'blacklist':
+            fake.count('blacklist')
+            self.reply(200, {'page': 1, 'pageSize': 10, 'totalRecords': 0, 'records': []})
+        elif match.group('version') is None:
+            # the unversioned radarr api sends the whole queue at once
+            fake.count('queue')
+            self.reply(200, fake.queue())
+        else:
+            fake.count('queue_page')
+            page = int(query.get('page', ['1'])[0])
+            page_size = int(query.get('pageSize', ['10'])[0])
+            descending = query.get('sortDirection', ['ascending'])[0] == 'descending'
+            self.reply(200, fake.page(page, page_size, descending))
+
+    def do_DELETE(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        routed = self.route()
+        if routed is None:
+            return
+        fake, (match, query) = self.server.fake, routed
+        item = match.group('item')
+        # the servers take blacklist=true/false, anything else is a bad request
+        blacklist = query.get('blacklist', ['false'])[0].lower()
+        if match.group('resource') != 'queue' or item is None:
+            self.reply(405)
+        elif blacklist not in ('true', 'false'):
+            self.reply(400, {'message': 'Invalid blacklist value'})
+        elif item == 'bulk':
+            if not fake.bulk_delete or match.group('version') is None:
+                self.reply(405)
+                return
+            fake.count('delete_bulk')
+            found = fake.delete(json.loads(body.decode('utf-8')).get('ids', []))
+            if blacklist == 'true':
+                for _ in found:
+                    fake.count('blacklisted')
+            self.reply(200, {})
+        else:
+            fake.count('delete')
+            if fake.delete([int(item)]):
+                if blacklist == 'true':
+                    fake.count('blacklisted')
+                self.reply(200, {})
+            else:
+                self.reply(404, {'message': 'Not Found'})
+
+
+class FakeArrServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fake):
+        HTTPServer.__init__(self, address, Handler)
+        self.fake = fake
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+
+def start(fake, host='127.0.0.1', port=0):
+    """Serves fake on a background thread, port 0 picks a free port"""
+    server = FakeArrServer((host, port), fake)
+    thread = threading.Thread(target=server.serve_forever, name='fakearr')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument('--queue-size', type=int, default=10000, help='number of queue records')
+    parser.add_argument('--max-page-size', type=int, default=1000, help='largest page the server sends')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with HTTP 500')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of requests taking --slow-latency')
+    parser.add_argument('--slow-latency', type=float, default=2.0, help='seconds a slow response takes')
+    parser.add_argument('--no-bulk-delete', action='store_true', help='answer bulk deletes with HTTP 405')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+
+
+def from_arguments(args, apikey=None):
+    return FakeArr(
+        queue_size=args.queue_size,
+        max_page_size=args.max_page_size,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        apikey=apikey,
+        bulk_delete=not args.no_bulk_delete,
+        seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake sonarr/radarr/lidarr server')
+    parser.add_argument('--host', default='127.0.0.1', help='interface to listen on')
+    parser.add_argument('--port', type=int, default=8989, help='port to listen on')
+    parser.add_argument('--apikey', default=None, help='required x-api-key, none by default')
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = FakeArrServer((args.host, args.port), from_arguments(args, args.apikey))
+    print("Serving {} queue records on {}/<sonarr|radarr|lidarr>/api".format(args.queue_size, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass